@@ -0,0 +1,260 @@
+"""
+Throughput of the sharded bot for 1, 2 and 4 worker processes, against a
+single process handling updates concurrently.
+
+    python benchmarks/bench_sharding.py [--updates 600] [--chats 64] [--workers 1 2 4] [--charts 0.1]
+
+Each worker runs the real `message_handler` (spool insert, activity buckets,
+recent-message ring, random quips and stickers) against in-memory MongoDB
+collections, a fake Bot API and a fake OpenAI client with fixed latencies.
+A share of the updates (`--charts`) are `/activity heatmap` commands, which
+render a matplotlib chart: CPU-bound work that only more processes can
+parallelize. The front routes synthetic updates through `ShardFront.route`,
+and the reported rate is updates handled per second from the first routed
+update to the last handled one, excluding process start-up.
+
+The `concurrent` baseline runs the same handlers in one process with
+`concurrent_updates(True)`. It overlaps the simulated network latency just
+like extra workers do, so only the gain of the sharded runs over it comes
+from using more cores.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The bot modules refuse to import without these; nothing connects to them.
+os.environ.setdefault("URI", "mongodb://localhost:27017")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+# Charts are rendered off-screen in every process.
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from telegram import Update  # noqa: E402
+from telegram.ext import (  # noqa: E402
+    ApplicationBuilder, ApplicationHandlerStop, CommandHandler, MessageHandler, filters,
+)
+
+from fake_services import FakeBot, FakeCollection, FakeOpenAI  # noqa: E402
+
+TOKEN = "123456:BENCHMARK"
+CHART_COMMAND = "/activity heatmap"
+
+
+class _Stats:
+    handled = 0
+    last_at = 0.0
+
+
+def _chat_id(index: int) -> int:
+    return -1000000000000 - index
+
+
+def _seed_activity(buckets: Any, chats: int, messages_per_chat: int = 2000) -> None:
+    """
+    Give every chat 90 days of hourly activity, so each `/activity heatmap`
+    renders a full chart however the updates are interleaved.
+    """
+    from activity_analytics import HOURS_PER_YEAR, _hour_of_year
+
+    rng = random.Random(11)
+    now = datetime.now(timezone.utc)
+    for index in range(chats):
+        years: Dict[int, List[int]] = {}
+        for _ in range(messages_per_chat):
+            ts = now - timedelta(seconds=rng.randrange(90 * 24 * 3600))
+            years.setdefault(ts.year, [0] * HOURS_PER_YEAR)[_hour_of_year(ts)] += 1
+        for year, hourly in years.items():
+            buckets.insert_one({"chat_id": _chat_id(index), "user_id": None, "year": year,
+                                "hourly": hourly, "total": sum(hourly)})
+
+
+def _wire_fakes() -> None:
+    """
+    Point every module the handlers touch at in-memory services. Runs inside
+    each worker process, before the application starts.
+    """
+    import db_functions
+    import ingest_spool
+    import activity_analytics
+    import ai_functions_lib
+    import sharding
+
+    messages = FakeCollection("messages")
+    db_functions.messages_collection = messages
+    db_functions.chat_info_collection = FakeCollection("chat_info")
+    ingest_spool.messages_collection = messages
+    activity_analytics.activity_buckets_collection = FakeCollection("activity_buckets")
+    _seed_activity(activity_analytics.activity_buckets_collection, int(os.environ["BENCH_CHATS"]))
+    sharding.worker_leases_collection = FakeCollection("worker_leases")
+    ingest_spool.ingest_spool.path = os.path.join(os.environ["BENCH_DIR"], f"spool-{os.getpid()}.db")
+    ai_functions_lib.openai = FakeOpenAI(float(os.environ["BENCH_OPENAI_LATENCY"]))
+
+
+class _BenchBot(FakeBot):
+    async def initialize(self) -> None:
+        await super().initialize()
+        open(os.path.join(os.environ["BENCH_DIR"], f"ready-{os.getpid()}"), "w").close()
+
+    async def shutdown(self) -> None:
+        with open(os.path.join(os.environ["BENCH_DIR"], f"stats-{os.getpid()}.json"), "w") as f:
+            json.dump({"handled": _Stats.handled, "last_at": _Stats.last_at}, f)
+        await super().shutdown()
+
+
+def _counted(handler: Any) -> Any:
+    async def counted_handler(update: Update, context: Any) -> None:
+        await handler(update, context)
+        _Stats.handled += 1
+        _Stats.last_at = time.time()
+    return counted_handler
+
+
+def build_bench_application(token: str, concurrent: bool = False) -> Any:
+    """
+    Worker-side counterpart of `main.build_application` with the fakes wired in.
+    """
+    _wire_fakes()
+    from command_handlers import message_handler
+    from stats_handlers import send_activity_chart
+
+    bot = _BenchBot(token, latency=float(os.environ["BENCH_TELEGRAM_LATENCY"]))
+    application = ApplicationBuilder().bot(bot).concurrent_updates(concurrent).build()
+    application.add_handler(CommandHandler("activity", _counted(send_activity_chart)))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), _counted(message_handler)))
+    return application
+
+
+def synthetic_updates(count: int, chats: int, chart_share: float = 0.1, seed: int = 7) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    now = int(datetime.now(timezone.utc).timestamp())
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = _chat_id(rng.randrange(chats))
+        user_id = 1000 + rng.randrange(50)
+        message = {
+            "message_id": update_id,
+            "date": now,
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        if rng.random() < chart_share:
+            message["text"] = CHART_COMMAND
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len("/activity")}]
+        else:
+            message["text"] = " ".join(rng.choice(["lol", "ok", "tomorrow?", "nice", "see you", "why"])
+                                       for _ in range(rng.randint(2, 12)))
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+
+def _result(mode: str, workers: int, handled: int, elapsed: float) -> Dict[str, Any]:
+    return {
+        "mode": mode,
+        "workers": workers,
+        "handled": handled,
+        "seconds": round(elapsed, 2),
+        "updates_per_second": round(handled / elapsed, 1),
+    }
+
+
+def run_concurrent(updates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Handle every update in this process with `concurrent_updates(True)`.
+    """
+    with tempfile.TemporaryDirectory() as bench_dir:
+        os.environ["BENCH_DIR"] = bench_dir
+        _Stats.handled, _Stats.last_at = 0, 0.0
+
+        async def handle_all() -> float:
+            application = build_bench_application(TOKEN, concurrent=True)
+            async with application:
+                await application.start()
+                started = time.time()
+                for data in updates:
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                while _Stats.handled < len(updates):
+                    await asyncio.sleep(0.01)
+                await application.stop()
+            return started
+
+        started = asyncio.run(handle_all())
+    return _result("concurrent", 1, _Stats.handled, _Stats.last_at - started)
+
+
+def run_sharded(num_workers: int, updates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from sharding import HashRing, ShardFront
+
+    with tempfile.TemporaryDirectory() as bench_dir:
+        os.environ["BENCH_DIR"] = bench_dir
+        front = ShardFront(TOKEN, num_workers, build_bench_application)
+        front.start_workers()
+        while len([name for name in os.listdir(bench_dir) if name.startswith("ready-")]) < num_workers:
+            if not all(process.is_alive() for process in front.processes.values()):
+                raise RuntimeError("A worker exited during start-up; see its log above.")
+            time.sleep(0.05)
+        # Every worker is up; skip the lease round trip and use them all.
+        front.ring = HashRing(front.worker_ids)
+        bot = FakeBot(TOKEN)
+
+        async def route_all() -> None:
+            for data in updates:
+                try:
+                    await front.route(Update.de_json(data, bot), None)
+                except ApplicationHandlerStop:
+                    pass
+
+        started = time.time()
+        asyncio.run(route_all())
+        routed_at = time.time()
+        # Unlike `stop_workers`, wait for as long as the backlog takes.
+        for queue in front.queues.values():
+            queue.put(None)
+        for process in front.processes.values():
+            process.join()
+
+        stats = []
+        for name in os.listdir(bench_dir):
+            if name.startswith("stats-"):
+                with open(os.path.join(bench_dir, name)) as f:
+                    stats.append(json.load(f))
+    result = _result("sharded", num_workers, sum(item["handled"] for item in stats),
+                     max(item["last_at"] for item in stats) - started)
+    result["routing_per_second"] = round(len(updates) / (routed_at - started), 1)
+    return result
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description="Measure sharded update throughput.")
+    parser.add_argument("--updates", type=int, default=600)
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--charts", type=float, default=0.1, help="Share of updates that render a chart.")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="Seconds per fake Bot API call.")
+    parser.add_argument("--openai-latency", type=float, default=0.1, help="Seconds per fake completion.")
+    args = parser.parse_args(argv)
+
+    os.environ["BENCH_TELEGRAM_LATENCY"] = str(args.telegram_latency)
+    os.environ["BENCH_OPENAI_LATENCY"] = str(args.openai_latency)
+    os.environ["BENCH_CHATS"] = str(args.chats)
+    updates = synthetic_updates(args.updates, args.chats, args.charts)
+    # Speedups are relative to the single concurrent process, not to one worker.
+    baseline = run_concurrent(updates)
+    baseline["speedup"] = 1.0
+    print(json.dumps(baseline))
+    for num_workers in args.workers:
+        result = run_sharded(num_workers, updates)
+        result["speedup"] = round(result["updates_per_second"] / baseline["updates_per_second"], 2)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,78 @@
+"""
+Stand-ins for Telegram and OpenAI used by the benchmarks, so the bot's real
+handlers run end to end without network access. Both simulate round-trip
+latency with a fixed delay; MongoDB is replaced by the in-memory collections
+from tests/fakes.py.
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, List
+
+from telegram import Chat, Message, User
+from telegram.ext import ExtBot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from fakes import FakeCollection  # noqa: E402
+
+
+class FakeBot(ExtBot):
+    """
+    An ExtBot whose API calls never leave the process. Every call sleeps for
+    `latency` seconds, like a round trip to the Bot API.
+    """
+
+    def __init__(self, token: str, latency: float = 0.01, **kwargs: Any):
+        super().__init__(token, **kwargs)
+        with self._unfrozen():
+            self._fake_latency = latency
+            self.sent: List[Any] = []
+
+    async def get_me(self, *args: Any, **kwargs: Any) -> User:
+        with self._unfrozen():
+            self._bot_user = User(id=1, is_bot=True, first_name="Bench", username="bench_bot")
+        return self._bot_user
+
+    async def _fake_call(self, chat_id: Any, payload: Any) -> Message:
+        await asyncio.sleep(self._fake_latency)
+        self.sent.append(payload)
+        return Message(len(self.sent), date=datetime.now(timezone.utc), chat=Chat(chat_id, Chat.GROUP))
+
+    async def send_message(self, chat_id: Any, text: str, *args: Any, **kwargs: Any) -> Message:
+        return await self._fake_call(chat_id, text)
+
+    async def send_sticker(self, chat_id: Any, sticker: Any, *args: Any, **kwargs: Any) -> Message:
+        return await self._fake_call(chat_id, sticker)
+
+    async def send_photo(self, chat_id: Any, photo: Any, *args: Any, **kwargs: Any) -> Message:
+        return await self._fake_call(chat_id, photo)
+
+    async def get_sticker_set(self, name: str, *args: Any, **kwargs: Any) -> Any:
+        await asyncio.sleep(self._fake_latency)
+        return SimpleNamespace(stickers=[SimpleNamespace(file_id=f"{name}-{i}") for i in range(5)])
+
+
+class FakeOpenAI:
+    """
+    Module-like replacement for `openai` as used by ai_functions_lib: the
+    blocking `chat.completions.create` sleeps for `latency` seconds.
+    """
+
+    OpenAIError = Exception
+
+    def __init__(self, latency: float = 0.1):
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model: str, messages: list, **kwargs: Any) -> Any:
+        time.sleep(self.latency)
+        self.calls += 1
+        content = f"fake reply #{self.calls}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+__all__ = ["FakeBot", "FakeCollection", "FakeOpenAI"]
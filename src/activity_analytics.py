@@ -0,0 +1,337 @@
+import sys
+import json
+import logging
+import argparse
+import itertools
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+load_dotenv()
+
+from db_functions import (
+    activity_buckets_collection,
+    messages_collection,
+    message_buckets_collection,
+    iter_archived_messages,
+)
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+# Each bucket document covers one UTC calendar year for one chat (hourly
+# counts, `user_id` None) or for one user in a chat (daily counts).
+HOURS_PER_YEAR = 366 * 24
+DAYS_PER_YEAR = 366
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def ensure_indexes() -> None:
+    """
+    Create the unique index bucket documents are addressed by.
+    """
+    activity_buckets_collection.create_index(
+        [("chat_id", ASCENDING), ("user_id", ASCENDING), ("year", ASCENDING)], unique=True
+    )
+
+
+def _as_utc(ts: datetime) -> datetime:
+    """
+    MongoDB returns naive UTC datetimes; Telegram gives aware ones.
+    """
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
+
+
+def _year_start(year: int) -> datetime:
+    return datetime(year, 1, 1, tzinfo=timezone.utc)
+
+
+def _hour_of_year(ts: datetime) -> int:
+    return int((ts - _year_start(ts.year)).total_seconds() // 3600)
+
+
+def _increment(key: Dict[str, Any], field: str, index: int, size: int, extra: Dict[str, Any]) -> None:
+    """
+    Increment one slot of a bucket array, creating the zero-filled bucket first
+    if it does not exist yet (positional $inc cannot upsert an array).
+    """
+    update: Dict[str, Any] = {"$inc": {f"{field}.{index}": 1, "total": 1}}
+    if extra:
+        update["$set"] = extra
+    if activity_buckets_collection.update_one(key, update).matched_count:
+        return
+    counts = [0] * size
+    counts[index] = 1
+    try:
+        activity_buckets_collection.insert_one({**key, field: counts, "total": 1, **extra})
+    except DuplicateKeyError:
+        # Another writer created the bucket in the meantime.
+        activity_buckets_collection.update_one(key, update)
+
+
+def record_activity(message_data: Dict[str, Any]) -> None:
+    """
+    Count a stored message in the chat's hourly bucket and the user's daily bucket.
+
+    Args:
+        message_data (Dict[str, Any]): A message document as passed to `insert_message`.
+    """
+    ts = _as_utc(message_data["timestamp"])
+    chat_id = message_data["chat_id"]
+    hour = _hour_of_year(ts)
+    _increment({"chat_id": chat_id, "user_id": None, "year": ts.year}, "hourly", hour, HOURS_PER_YEAR, {})
+    _increment(
+        {"chat_id": chat_id, "user_id": message_data["user_id"], "year": ts.year},
+        "daily", hour // 24, DAYS_PER_YEAR,
+        {"username": message_data.get("username"), "full_name": message_data.get("full_name")},
+    )
+
+
+def _replace_bucket(bucket: Dict[str, Any]) -> None:
+    key = {"chat_id": bucket["chat_id"], "user_id": bucket["user_id"], "year": bucket["year"]}
+    try:
+        activity_buckets_collection.replace_one(key, bucket, upsert=True)
+    except DuplicateKeyError:
+        # A live `_increment` created the bucket between our match and upsert.
+        activity_buckets_collection.replace_one(key, bucket)
+
+
+def rebuild_activity(chat_id: int) -> int:
+    """
+    Recompute a chat's buckets from its raw and archived messages, e.g. after an
+    import or to backfill history stored before the buckets existed.
+
+    Each bucket is replaced in place, so live increments never see the chat
+    without buckets. Messages stored while the rebuild runs may be counted
+    twice or not at all; buckets of users without any messages are left alone.
+
+    Args:
+        chat_id (int): The chat identifier.
+
+    Returns:
+        int: The number of messages counted.
+    """
+    hourly: Dict[int, np.ndarray] = {}
+    daily: Dict[Tuple[int, int], np.ndarray] = {}
+    names: Dict[int, Dict[str, Any]] = {}
+    count = 0
+    cursor = messages_collection.find(
+        {"chat_id": chat_id}, {"user_id": 1, "username": 1, "full_name": 1, "timestamp": 1}
+    ).sort("timestamp", ASCENDING)
+    for doc in itertools.chain(iter_archived_messages(chat_id), cursor):
+        ts = _as_utc(doc["timestamp"])
+        hour = _hour_of_year(ts)
+        hourly.setdefault(ts.year, np.zeros(HOURS_PER_YEAR, dtype=np.int64))[hour] += 1
+        daily.setdefault((doc["user_id"], ts.year), np.zeros(DAYS_PER_YEAR, dtype=np.int64))[hour // 24] += 1
+        names[doc["user_id"]] = {"username": doc.get("username"), "full_name": doc.get("full_name")}
+        count += 1
+
+    for year, counts in hourly.items():
+        _replace_bucket({
+            "chat_id": chat_id, "user_id": None, "year": year,
+            "hourly": counts.tolist(), "total": int(counts.sum()),
+        })
+    for (user_id, year), counts in daily.items():
+        _replace_bucket({
+            "chat_id": chat_id, "user_id": user_id, "year": year,
+            "daily": counts.tolist(), "total": int(counts.sum()), **names[user_id],
+        })
+    return count
+
+
+def all_chat_ids() -> List[int]:
+    """
+    Return every chat with raw or archived messages.
+    """
+    return sorted(set(messages_collection.distinct("chat_id")) | set(message_buckets_collection.distinct("chat_id")))
+
+
+# ---------------------------------------------------------------------
+# Queries
+# ---------------------------------------------------------------------
+def _year_slices(start: datetime, end: datetime, unit_hours: int) -> Iterator[Tuple[int, int, int]]:
+    """
+    Split [start, end) into per-year (year, first slot, slot count) ranges, where
+    a slot is `unit_hours` long and both bounds are floored to whole slots.
+    """
+    year = start.year
+    while year <= end.year:
+        year_start = _year_start(year)
+        lo = max(start, year_start)
+        hi = min(end, _year_start(year + 1))
+        first = int((lo - year_start).total_seconds() // (unit_hours * 3600))
+        last = int((hi - year_start).total_seconds() // (unit_hours * 3600))
+        if last > first:
+            yield year, first, last - first
+        year += 1
+
+
+def chat_hourly(chat_id: int, start: datetime, end: datetime) -> np.ndarray:
+    """
+    Return the chat's message counts for every UTC hour in [start, end).
+
+    Args:
+        chat_id (int): The chat identifier.
+        start (datetime): Window start, floored to the hour.
+        end (datetime): Window end (exclusive), floored to the hour.
+
+    Returns:
+        np.ndarray: One count per hour, zeros where there was no activity.
+    """
+    parts = []
+    for year, first, length in _year_slices(_as_utc(start), _as_utc(end), 1):
+        doc = activity_buckets_collection.find_one(
+            {"chat_id": chat_id, "user_id": None, "year": year},
+            {"hourly": {"$slice": [first, length]}, "_id": 0},
+        )
+        counts = np.zeros(length, dtype=np.int64)
+        if doc:
+            values = np.asarray(doc["hourly"], dtype=np.int64)
+            counts[:len(values)] = values
+        parts.append(counts)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+def _day_floor(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _stored_user_counts(chat_id: int, start: datetime, end: datetime,
+                        totals: Dict[Any, int], names: Dict[Any, Dict[str, Any]]) -> None:
+    """
+    Add per-user counts of the raw and archived messages in [start, end) to `totals`.
+    """
+    cursor = messages_collection.find(
+        {"chat_id": chat_id, "timestamp": {"$gte": start, "$lt": end}},
+        {"user_id": 1, "username": 1, "full_name": 1},
+    )
+    for doc in itertools.chain(iter_archived_messages(chat_id, start, end), cursor):
+        totals[doc["user_id"]] = totals.get(doc["user_id"], 0) + 1
+        names.setdefault(doc["user_id"], {"username": doc.get("username"), "full_name": doc.get("full_name")})
+
+
+def user_totals(chat_id: int, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+    """
+    Return per-user message counts for [start, end).
+
+    Whole UTC days come from the daily buckets. The partial days at either end
+    (e.g. a window starting at local midnight) are counted from the stored
+    messages, which is cheap because they span less than a day each.
+
+    Returns:
+        List[Dict[str, Any]]: Entries with user_id, username, full_name and count,
+                              most active first; users without messages are omitted.
+    """
+    start, end = _as_utc(start), _as_utc(end)
+    totals: Dict[Any, int] = {}
+    names: Dict[Any, Dict[str, Any]] = {}
+    first_day = _day_floor(start - timedelta(microseconds=1)) + timedelta(days=1)
+    last_day = _day_floor(end)
+    if first_day >= last_day:
+        _stored_user_counts(chat_id, start, end, totals, names)
+        first_day = last_day = end
+    for year, first, length in _year_slices(first_day, last_day, 24):
+        docs = list(activity_buckets_collection.find(
+            {"chat_id": chat_id, "year": year, "user_id": {"$ne": None}},
+            {"daily": {"$slice": [first, length]}, "user_id": 1, "username": 1, "full_name": 1, "_id": 0},
+        ))
+        if not docs:
+            continue
+        matrix = np.zeros((len(docs), length), dtype=np.int64)
+        for row, doc in enumerate(docs):
+            matrix[row, :len(doc["daily"])] = doc["daily"]
+        for doc, count in zip(docs, matrix.sum(axis=1)):
+            totals[doc["user_id"]] = totals.get(doc["user_id"], 0) + int(count)
+            names[doc["user_id"]] = {"username": doc.get("username"), "full_name": doc.get("full_name")}
+    if first_day < last_day:
+        if start < first_day:
+            _stored_user_counts(chat_id, start, first_day, totals, names)
+        if last_day < end:
+            _stored_user_counts(chat_id, last_day, end, totals, names)
+    ranked = sorted((item for item in totals.items() if item[1]), key=lambda item: item[1], reverse=True)
+    return [{"user_id": user_id, "count": count, **names[user_id]} for user_id, count in ranked]
+
+
+def _local_starts(start: datetime, hours: int, tz) -> List[datetime]:
+    """
+    Return the local start time of each of `hours` hours from `start` (UTC,
+    whole hour), using the offset in effect at that hour, so DST changes and
+    non-whole-hour offsets are placed correctly.
+    """
+    return [(start + timedelta(hours=i)).astimezone(tz) for i in range(hours)]
+
+
+def hour_of_week_heatmap(chat_id: int, start: datetime, end: datetime, tz=timezone.utc) -> np.ndarray:
+    """
+    Return a 7x24 matrix (Monday first) of message counts by local weekday and hour.
+
+    Args:
+        chat_id (int): The chat identifier.
+        start (datetime): Window start.
+        end (datetime): Window end (exclusive).
+        tz (tzinfo): Timezone used to place hours. Each UTC hour is counted
+                     under the local hour it starts in (with offsets like +5:30,
+                     10:00 UTC counts as 15:00 local).
+
+    Returns:
+        np.ndarray: Array of shape (7, 24).
+    """
+    start = _as_utc(start).replace(minute=0, second=0, microsecond=0)
+    counts = chat_hourly(chat_id, start, end)
+    slot = np.array([local.weekday() * 24 + local.hour for local in _local_starts(start, len(counts), tz)],
+                    dtype=np.int64)
+    return np.bincount(slot, weights=counts, minlength=7 * 24).astype(np.int64).reshape(7, 24)
+
+
+def daily_trend(chat_id: int, days: int = 30, tz=timezone.utc,
+                now: Optional[datetime] = None) -> Tuple[List[datetime], np.ndarray]:
+    """
+    Return message counts for each of the last `days` local days, today included.
+    Each UTC hour is counted on the local day it starts in.
+
+    Returns:
+        Tuple[List[datetime], np.ndarray]: The local day starts and their counts.
+    """
+    today = _as_utc(now or datetime.now(timezone.utc)).astimezone(tz).date()
+    local_days = [today - timedelta(days=days - 1 - i) for i in range(days)]
+    day_starts = [datetime(day.year, day.month, day.day, tzinfo=tz) for day in local_days]
+    start = _as_utc(day_starts[0].astimezone(timezone.utc)).replace(minute=0, second=0, microsecond=0)
+    tomorrow = today + timedelta(days=1)
+    end = datetime(tomorrow.year, tomorrow.month, tomorrow.day, tzinfo=tz).astimezone(timezone.utc)
+    counts = chat_hourly(chat_id, start, end)
+    index = {day: i for i, day in enumerate(local_days)}
+    totals = np.zeros(days, dtype=np.int64)
+    for local, count in zip(_local_starts(start, len(counts), tz), counts):
+        # The hour straddling the first local midnight (e.g. +5:30) starts the day before.
+        i = index.get(local.date())
+        if i is not None:
+            totals[i] += count
+    return day_starts, totals
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Rebuild activity buckets from stored messages.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("rebuild", help="Recount chats, e.g. once after deploying the buckets.")
+    rebuild.add_argument("chat_ids", type=int, nargs="*", help="Chats to rebuild.")
+    rebuild.add_argument("--all", action="store_true", help="Rebuild every chat with stored messages.")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if not args.all and not args.chat_ids:
+        parser.error("pass chat ids or --all")
+    ensure_indexes()
+    counts = {}
+    for chat_id in (all_chat_ids() if args.all else args.chat_ids):
+        counts[chat_id] = rebuild_activity(chat_id)
+        logger.info(f"Rebuilt activity of chat {chat_id} from {counts[chat_id]} messages.")
+    print(json.dumps({"chats": len(counts), "messages": sum(counts.values())}, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
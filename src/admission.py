@@ -0,0 +1,259 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from enum import IntEnum
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """
+    Priority tiers for AI work. Lower values are served first.
+    """
+    COMMAND = 0    # Explicit user commands: /ask, /summary, /profile, /topic.
+    SCHEDULED = 1  # Scheduled background work such as daily digests.
+    QUIP = 2       # Random comments from message_handler.
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a unit of work is shed, either on admission or because it
+    waited in its queue past the tier deadline.
+    """
+
+
+# Defaults per tier: (max queued, max seconds spent waiting in the queue).
+DEFAULT_QUEUE_LIMITS: Dict[Priority, int] = {
+    Priority.COMMAND: 64,
+    Priority.SCHEDULED: 32,
+    Priority.QUIP: 8,
+}
+DEFAULT_QUEUE_DEADLINES: Dict[Priority, float] = {
+    Priority.COMMAND: 30.0,
+    Priority.SCHEDULED: 120.0,
+    Priority.QUIP: 5.0,
+}
+
+
+class AdmissionController:
+    """
+    Priority-aware admission control for blocking AI calls.
+
+    At most `max_in_flight` calls run at once (each in a worker thread). Work that
+    cannot start immediately waits in a bounded per-tier queue and is dispatched
+    strictly by priority. Anything below COMMAND priority is shed up front when
+    the in-flight count or the smoothed call latency crosses its threshold, so
+    explicit commands keep their capacity when a busy group floods the bot.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 4,
+        queue_limits: Optional[Dict[Priority, int]] = None,
+        queue_deadlines: Optional[Dict[Priority, float]] = None,
+        shed_in_flight: Optional[Dict[Priority, int]] = None,
+        shed_latency: Optional[Dict[Priority, float]] = None,
+        latency_alpha: float = 0.2,
+        latency_half_life: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            max_in_flight (int): Maximum number of calls running concurrently.
+            queue_limits (Dict[Priority, int]): Maximum queued calls per tier.
+            queue_deadlines (Dict[Priority, float]): Seconds a call may wait in the
+                                                     queue before it is dropped.
+            shed_in_flight (Dict[Priority, int]): Reject new work of a tier when at
+                                                  least this many calls are running.
+            shed_latency (Dict[Priority, float]): Reject new work of a tier when the
+                                                  smoothed latency (seconds) exceeds this.
+            latency_alpha (float): Smoothing factor for the latency moving average.
+            latency_half_life (float): Seconds without a completed call after which the
+                                       smoothed latency has decayed to half, so shed
+                                       tiers are let through again once the backend idles.
+            clock (Callable[[], float]): Monotonic clock, injectable for tests.
+        """
+        self.max_in_flight = max_in_flight
+        self.queue_limits = {**DEFAULT_QUEUE_LIMITS, **(queue_limits or {})}
+        self.queue_deadlines = {**DEFAULT_QUEUE_DEADLINES, **(queue_deadlines or {})}
+        # By default scheduled work queues behind commands while quips back off early.
+        self.shed_in_flight = {
+            Priority.QUIP: max(1, max_in_flight // 2),
+            **(shed_in_flight or {}),
+        }
+        self.shed_latency = {
+            Priority.SCHEDULED: 20.0,
+            Priority.QUIP: 8.0,
+            **(shed_latency or {}),
+        }
+        self.latency_alpha = latency_alpha
+        self.latency_half_life = latency_half_life
+        self.clock = clock
+
+        self.in_flight = 0
+        self.latency_ewma = 0.0
+        self._latency_sampled_at = clock()
+        self._queues: Dict[Priority, Deque[Tuple[float, asyncio.Future]]] = {
+            priority: deque() for priority in Priority
+        }
+        self.metrics: Dict[str, Dict[str, int]] = {
+            name: {priority.name: 0 for priority in Priority}
+            for name in ("admitted", "shed", "expired", "completed")
+        }
+
+    def queue_depth(self, priority: Priority) -> int:
+        """
+        Return the number of calls currently waiting in a tier's queue.
+        """
+        return len(self._queues[priority])
+
+    def set_max_in_flight(self, max_in_flight: int) -> None:
+        """
+        Change the concurrency limit, e.g. to split a deployment-wide limit
+        across processes. In-flight shedding thresholds are scaled along with it.
+        """
+        scale = max_in_flight / self.max_in_flight
+        self.shed_in_flight = {
+            priority: max(1, int(limit * scale)) for priority, limit in self.shed_in_flight.items()
+        }
+        self.max_in_flight = max_in_flight
+
+    def current_latency(self, at: Optional[float] = None) -> float:
+        """
+        Return the smoothed call latency, decayed by the time since the last sample.
+
+        Shed work never runs and so never reports a fast call; without the decay a
+        single slow burst would keep the lower tiers shed until a command completes.
+        """
+        idle = max(0.0, (self.clock() if at is None else at) - self._latency_sampled_at)
+        return self.latency_ewma * 0.5 ** (idle / self.latency_half_life)
+
+    def _record_latency(self, started: float) -> None:
+        """
+        Fold a completed call's duration into the smoothed latency. Only the idle
+        time before the call started counts towards the decay.
+        """
+        now = self.clock()
+        base = self.current_latency(at=started)
+        self.latency_ewma = base + self.latency_alpha * (now - started - base)
+        self._latency_sampled_at = max(self._latency_sampled_at, now)
+
+    def _should_shed(self, priority: Priority) -> bool:
+        """
+        Decide whether new work of the given tier must be rejected outright.
+        """
+        in_flight_limit = self.shed_in_flight.get(priority)
+        if in_flight_limit is not None and self.in_flight >= in_flight_limit:
+            return True
+        latency_limit = self.shed_latency.get(priority)
+        if latency_limit is not None and self.current_latency() > latency_limit:
+            return True
+        return len(self._queues[priority]) >= self.queue_limits[priority]
+
+    def _has_waiters(self, up_to: Priority) -> bool:
+        """
+        Check whether any call of the same or a higher priority is already queued.
+        """
+        return any(self._queues[priority] for priority in Priority if priority <= up_to)
+
+    def _dispatch(self) -> None:
+        """
+        Hand free slots to queued callers, highest priority first, dropping any
+        caller whose queue deadline has already passed.
+        """
+        now = self.clock()
+        for priority in Priority:
+            queue = self._queues[priority]
+            deadline = self.queue_deadlines[priority]
+            while queue and self.in_flight < self.max_in_flight:
+                enqueued_at, waiter = queue.popleft()
+                if waiter.done():
+                    continue
+                if now - enqueued_at > deadline:
+                    self.metrics["expired"][priority.name] += 1
+                    waiter.set_exception(OverloadedError(f"{priority.name} work expired in queue"))
+                    continue
+                self.in_flight += 1
+                waiter.set_result(None)
+            if self.in_flight >= self.max_in_flight:
+                return
+
+    async def _acquire(self, priority: Priority) -> None:
+        """
+        Wait for an execution slot or raise OverloadedError if the work is shed.
+        """
+        if priority != Priority.COMMAND and self._should_shed(priority):
+            self.metrics["shed"][priority.name] += 1
+            raise OverloadedError(f"{priority.name} work shed under load")
+
+        if self.in_flight < self.max_in_flight and not self._has_waiters(priority):
+            self.in_flight += 1
+            return
+
+        if len(self._queues[priority]) >= self.queue_limits[priority]:
+            self.metrics["shed"][priority.name] += 1
+            raise OverloadedError(f"{priority.name} queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (self.clock(), waiter)
+        self._queues[priority].append(entry)
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_deadlines[priority])
+        except asyncio.TimeoutError:
+            self.metrics["expired"][priority.name] += 1
+            raise OverloadedError(f"{priority.name} work expired in queue") from None
+        except asyncio.CancelledError:
+            # A slot may have been granted just before the caller went away.
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self._release()
+            raise
+        finally:
+            if entry in self._queues[priority]:
+                self._queues[priority].remove(entry)
+
+    def _release(self) -> None:
+        """
+        Free an execution slot and wake up the next eligible caller.
+        """
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def run(self, priority: Priority, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a blocking callable in a worker thread once admitted.
+
+        Args:
+            priority (Priority): The tier the work belongs to.
+            func (Callable[..., Any]): The blocking function to call.
+            *args, **kwargs: Arguments passed to `func`.
+
+        Returns:
+            Any: Whatever `func` returns.
+
+        Raises:
+            OverloadedError: If the work was shed or expired before it could start.
+        """
+        await self._acquire(priority)
+        self.metrics["admitted"][priority.name] += 1
+        started = self.clock()
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        finally:
+            self._record_latency(started)
+            self.metrics["completed"][priority.name] += 1
+            self._release()
+
+
+# Shared controller for OpenAI calls, tunable from the environment. AI_MAX_IN_FLIGHT is
+# the limit for the whole deployment; sharding.py splits it across its processes.
+ai_admission = AdmissionController(
+    max_in_flight=int(os.getenv("AI_MAX_IN_FLIGHT", "4")),
+    shed_latency={
+        Priority.SCHEDULED: float(os.getenv("AI_SHED_SCHEDULED_LATENCY", "20")),
+        Priority.QUIP: float(os.getenv("AI_SHED_QUIP_LATENCY", "8")),
+    },
+)
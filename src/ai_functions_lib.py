@@ -1,4 +1,6 @@
 import os
+import re
+import asyncio
 import logging
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
@@ -7,6 +9,8 @@ import openai
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from admission import Priority, OverloadedError, ai_admission
+
 # Load environment variables and configure logger.
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -16,6 +20,11 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 if not openai.api_key:
     raise ValueError("The OpenAI API key is not set. Please set the OPENAI_API_KEY environment variable.")
 
+# Reply returned by `_generate_completion` when the OpenAI call fails.
+AI_ERROR_MESSAGE = "I'm sorry, but I'm currently unable to process that request."
+# How far back /profile looks into archived (compacted) history.
+PROFILE_ARCHIVE_DAYS = int(os.getenv("PROFILE_ARCHIVE_DAYS", "365"))
+
 # ---------------------------------------------------------------------
 # Helper Functions for OpenAI API Calls
 # ---------------------------------------------------------------------
@@ -41,7 +50,7 @@ def _generate_completion(messages: list, max_tokens: int = 150, temperature: flo
         return response.choices[0].message.content.strip()
     except openai.OpenAIError as e:
         logger.error(f"OpenAI API error: {e}")
-        return "I'm sorry, but I'm currently unable to process that request."
+        return AI_ERROR_MESSAGE
 
 def generate_response(prompt: str, context_text: str, max_tokens: int = 150, temperature: float = 0.7) -> str:
     """
@@ -63,6 +72,89 @@ def generate_response(prompt: str, context_text: str, max_tokens: int = 150, tem
     ]
     return _generate_completion(messages, max_tokens, temperature)
 
+async def _admitted_completion(messages: list, max_tokens: int = 150, temperature: float = 0.7,
+                               priority: Priority = Priority.COMMAND) -> str:
+    """
+    Run `_generate_completion` through the shared admission controller.
+    
+    Args:
+        messages (list): List of message dictionaries.
+        max_tokens (int): Maximum tokens to generate.
+        temperature (float): Sampling temperature.
+        priority (Priority): The admission tier of the request.
+    
+    Returns:
+        str: The generated text or an error message.
+    
+    Raises:
+        OverloadedError: If the request was shed under load.
+    """
+    return await ai_admission.run(priority, _generate_completion, messages, max_tokens, temperature)
+
+async def generate_response_admitted(prompt: str, context_text: str, max_tokens: int = 150,
+                                     temperature: float = 0.7, priority: Priority = Priority.QUIP) -> str:
+    """
+    Async counterpart of `generate_response` that goes through admission control.
+    Defaults to the lowest tier since it backs the random quips.
+    
+    Raises:
+        OverloadedError: If the request was shed under load.
+    """
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": f"Context:\n{context_text}\n\nQuestion:\n{prompt}"}
+    ]
+    return await _admitted_completion(messages, max_tokens, temperature, priority)
+
+async def _reply_completion(update: Update, messages: list, max_tokens: int = 150,
+                            temperature: float = 0.7, prefix: str = "") -> None:
+    """
+    Generate a completion for an explicit command and reply with it, telling the
+    user to retry later if the request was shed.
+    """
+    try:
+        answer = await _admitted_completion(messages, max_tokens, temperature, Priority.COMMAND)
+    except OverloadedError as e:
+        logger.warning(f"AI command shed: {e}")
+        await update.message.reply_text("I'm a bit overloaded right now, please try again in a moment.")
+        return
+    await update.message.reply_text(f"{prefix}{answer}")
+
+def _compile_or_none(pattern: str, flags: int = 0):
+    """
+    Compile a user-supplied regex, returning None if it is not valid Python syntax.
+    """
+    try:
+        return re.compile(pattern, flags)
+    except re.error:
+        return None
+
+def _search_archive(chat_id: int, matches, limit: int, username: str = None, name_pattern=None) -> list:
+    """
+    Return up to `limit` archived messages of a chat matching `matches`, newest
+    first, from the last PROFILE_ARCHIVE_DAYS days. Blocking; run it in a thread.
+
+    If the name resolves to exactly one user of the chat (by username, or by a
+    full name matching `name_pattern`), only buckets holding that user's
+    messages are read, using the `user_counts.user_id` index.
+    """
+    from db_functions import get_profile_names, iter_archived_messages
+
+    user_ids = [
+        user_id for user_id, names in get_profile_names(chat_id).items()
+        if (username is not None and names.get("username") == username)
+        or (name_pattern is not None and name_pattern.search(names.get("full_name") or ""))
+    ]
+    user_id = user_ids[0] if len(user_ids) == 1 else None
+    start = datetime.now(timezone.utc) - timedelta(days=PROFILE_ARCHIVE_DAYS)
+    found = []
+    for msg in iter_archived_messages(chat_id, start=start, user_id=user_id, newest_first=True):
+        if matches(msg):
+            found.append(msg)
+            if len(found) == limit:
+                break
+    return found
+
 # ---------------------------------------------------------------------
 # AI Command Handlers
 # ---------------------------------------------------------------------
@@ -85,8 +177,7 @@ async def ask_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         {"role": "user", "content": full_prompt}
     ]
     
-    answer = _generate_completion(messages, max_tokens=150, temperature=0.7)
-    await update.message.reply_text(answer)
+    await _reply_completion(update, messages, max_tokens=150, temperature=0.7)
 
 async def remember_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -113,10 +204,15 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = context.args[0]
     chat_id = update.effective_chat.id
     from db_functions import messages_collection
+    from message_cache import message_cache
 
+    username = None
     if name.startswith('@'):
         username = name[1:]
         display_name = f"@{username}"
+        pattern = _compile_or_none(f'@{username}')
+        matches = lambda msg: (msg.get('username') == username
+                               or bool(pattern.search(msg.get('text') or '')))
         query = {
             '$or': [
                 {'username': username},
@@ -126,6 +222,9 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
     else:
         display_name = name
+        pattern = _compile_or_none(name, re.IGNORECASE)
+        matches = lambda msg: (bool(pattern.search(msg.get('full_name') or ''))
+                               or bool(pattern.search(msg.get('text') or '')))
         query = {
             '$or': [
                 {'full_name': {'$regex': name, '$options': 'i'}},
@@ -134,7 +233,18 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'chat_id': chat_id
         }
 
-    messages_cursor = messages_collection.find(query).sort('timestamp', -1).limit(100)
+    # Serve from the in-process ring when it holds enough matches, otherwise ask MongoDB.
+    messages_cursor = message_cache.search(chat_id, matches, 100) if pattern else None
+    if messages_cursor is None:
+        messages_cursor = list(messages_collection.find(query).sort('timestamp', -1).limit(100))
+    if len(messages_cursor) < 100 and pattern:
+        # Older messages may have been compacted into archive buckets.
+        seen = {msg['message_id'] for msg in messages_cursor}
+        archived = await asyncio.to_thread(
+            _search_archive, chat_id, matches, 100 - len(messages_cursor),
+            username, None if username is not None else pattern,
+        )
+        messages_cursor += [msg for msg in archived if msg['message_id'] not in seen]
     messages_text = '\n'.join([msg.get('text', '') for msg in messages_cursor])
     if not messages_text.strip():
         await update.message.reply_text("User not found.")
@@ -145,17 +255,16 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": prompt}
     ]
-    summary = _generate_completion(messages_list, max_tokens=150, temperature=0.7)
-    await update.message.reply_text(summary)
+    await _reply_completion(update, messages_list, max_tokens=150, temperature=0.7)
 
 async def topic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /topic command: Identifies the main topics discussed in recent chat messages.
     """
     chat_id = update.effective_chat.id
-    from db_functions import messages_collection
-    recent_msgs_cursor = messages_collection.find({'chat_id': chat_id}).sort('timestamp', -1).limit(100)
-    messages_text = '\n'.join([msg.get('text', '') for msg in reversed(list(recent_msgs_cursor)) if msg.get('text')])
+    from message_cache import message_cache
+    recent_msgs = message_cache.recent(chat_id, 100)
+    messages_text = '\n'.join([msg.get('text', '') for msg in recent_msgs if msg.get('text')])
     
     if not messages_text:
         await update.message.reply_text("I don't have enough info yet.")
@@ -166,33 +275,36 @@ async def topic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": f"Context:\n{messages_text}\n\nQuestion:\n{prompt}"}
     ]
-    topics = _generate_completion(messages_list, max_tokens=150, temperature=0.7)
-    await update.message.reply_text(f"Main topics:\n{topics}")
+    await _reply_completion(update, messages_list, max_tokens=150, temperature=0.7, prefix="Main topics:\n")
 
 async def daily_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    /daily_summary command: Provides a bullet-point summary of today's messages. 
+    /daily_summary command: Provides a bullet-point summary of today's messages.
+    Serves the precomputed digest right away, refreshing it in the background
+    when it has fallen behind, and generates it on demand only if none exists.
     """
     chat_id = update.effective_chat.id
-    from db_functions import messages_collection
-    now = datetime.now(timezone.utc) + timedelta(hours=1)  # Adjust for desired timezone (e.g., Europe UTC+1)
-    today_start = datetime(now.year, now.month, now.day)
-    today_end = today_start + timedelta(days=1)
-    
-    messages_cursor = messages_collection.find({
-        'chat_id': chat_id,
-        'timestamp': {'$gte': today_start, '$lt': today_end}
-    }).sort('timestamp', -1).limit(100)
-    
-    messages_text = '\n'.join([msg.get('text', '') for msg in messages_cursor])
-    if not messages_text.strip():
+    from digests import chat_timezone, get_stored_digest, build_digest, refresh_digest, refresh_due
+    tz = chat_timezone(chat_id)
+    today = datetime.now(tz).date()
+
+    digest = get_stored_digest(chat_id, today)
+    if digest:
+        if refresh_due(digest, chat_id, today, tz):
+            context.application.create_task(refresh_digest(chat_id, today, tz))
+    else:
+        try:
+            digest = await build_digest(chat_id, today, tz, Priority.COMMAND)
+        except OverloadedError as e:
+            logger.warning(f"AI command shed: {e}")
+            await update.message.reply_text("I'm a bit overloaded right now, please try again in a moment.")
+            return
+        except RuntimeError as e:
+            logger.error(f"Error building digest: {e}")
+            await update.message.reply_text(AI_ERROR_MESSAGE)
+            return
+
+    if not digest:
         await update.message.reply_text("I don't have enough info yet.")
         return
-
-    prompt = f"Provide a bullet point summary of the following messages from today:\n\n{messages_text} keep it short and structured. You can add some extra formatting suitable for telegram messages if that's helpfull try to keep it less than 150 characters "
-    messages_list = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": prompt}
-    ]
-    summary = _generate_completion(messages_list, max_tokens=200, temperature=0.7)
-    await update.message.reply_text(summary)
+    await update.message.reply_text(digest["summary"])
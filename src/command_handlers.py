@@ -2,6 +2,7 @@ import os
 import random
 import io
 from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 # from db_functions import logger
 import logging
 import pandas as pd
@@ -19,13 +20,20 @@ from db_functions import (
     memory_collection,
     chat_info_collection,
     get_statistics_text,
-    insert_message,
+    get_chat_info,
+    update_chat_info,
 )
+from scheduler import scheduler
+from activity_analytics import user_totals
+from ingest_spool import ingest_spool
+from message_cache import message_cache
 # Set up and export the logger.
 logger = logging.getLogger(__name__)
 
 
-from ai_functions_lib import generate_response
+from ai_functions_lib import generate_response_admitted
+from admission import OverloadedError
+from digests import chat_timezone, local_day_bounds
 
 # Number of messages before triggering a random GIF/sticker response.
 N = 5
@@ -121,19 +129,25 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'timestamp': message.date
     }
 
+    # Falls back to the local spool when MongoDB is slow or down; activity
+    # buckets are updated once the message actually reaches MongoDB.
     try:
-        insert_message(doc)
+        await ingest_spool.store(doc)
     except Exception as e:
         # Log the error to help diagnose issues.
-        import logging
-        logging.getLogger(__name__).error(f"Error inserting message: {e}")
+        logger.error(f"Error inserting message: {e}")
+    else:
+        message_cache.ingest(doc)
     
     # Occasionally send a random AI comment (1 in 8 chance).
     if random.randint(1, 8) == 1:
         try:
             prompt = f"Write a humorous short comment about the following message:\n\n{message.text}, feel free to add emojies or be informal and funny. Don't add additional confirmation and quotation marks on this message becouse you are telegram bot"
-            ai_comment = generate_response(prompt, "")
+            ai_comment = await generate_response_admitted(prompt, "")
             await message.reply_text(ai_comment)
+        except OverloadedError as e:
+            # Quips are the first thing to go when the bot is busy.
+            logger.debug(f"Skipping AI comment: {e}")
         except Exception as e:
             logger.error(f"Error generating AI comment: {e}")
 
@@ -218,13 +232,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = """
     📋 *Commands:*
     /help - Show this help message
-    /stats - Check out chat activity statistics
+    /stats [day|week|month] - Check out chat activity statistics
     /ask [question] - Ask anything to AI.
     /summary - Today's bullet point summary
     /topic - Get main topics from recent discussions
     /profile [@username or Name] - Get what the group knows about the user 
     /remember [[text]] - Add a short memory to further AI prompts(limited).
-    /activity - Shows the percentage of messages sent by each person
+    /activity [heatmap|trend] - Shows the percentage of messages sent by each person, or when the chat is active
+    /timezone [Area/City] - Show or set the chat's timezone (used for /summary days and charts)
     """
 
     button = InlineKeyboardButton("☕ - on service", callback_data='coffee')
@@ -236,9 +251,57 @@ async def statistics_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     Retrieve and display chat statistics.
     """
     chat_id = update.effective_chat.id
-    stats_text = get_statistics_text(chat_id)
+    periods = {'day': 1, 'week': 7, 'month': 30}
+    if context.args and context.args[0] in periods:
+        stats_text = get_period_statistics_text(chat_id, context.args[0], periods[context.args[0]])
+    else:
+        stats_text = get_statistics_text(chat_id)
     await update.message.reply_text(stats_text, parse_mode='Markdown')
 
+def get_period_statistics_text(chat_id: int, period: str, days: int) -> str:
+    """
+    Build a per-user activity summary for the last `days` days (today included),
+    counted in the chat's timezone.
+    """
+    tz = chat_timezone(chat_id)
+    today = datetime.now(tz).date()
+    start, _ = local_day_bounds(today - timedelta(days=days - 1), tz)
+    _, end = local_day_bounds(today, tz)
+    users = user_totals(chat_id, start, end)
+    total = sum(user["count"] for user in users)
+    stats_text = f"📊 *Chat Statistics (last {period}):*\n\nTotal messages: {total}\n\n*User Activity:*\n"
+    for user in users:
+        username = user.get("username")
+        user_display = f"@{username}" if username else user.get("full_name") or "Unknown"
+        stats_text += f"{user_display}: {user['count']} messages\n"
+    return stats_text
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Show the chat's timezone, or set it (group admins only), e.g. /timezone Europe/Amsterdam.
+    The timezone decides where a chat's day starts for digests and activity charts.
+    """
+    chat = update.effective_chat
+    if not context.args:
+        current = get_chat_info(chat.id).get("timezone") or "not set, using the bot default"
+        await update.message.reply_text(f"🕒 Timezone: {current}\nUsage: /timezone Area/City")
+        return
+
+    if chat.type != "private":
+        member = await context.bot.get_chat_member(chat.id, update.effective_user.id)
+        if member.status not in ("administrator", "creator"):
+            await update.message.reply_text("Only group admins can change the timezone.")
+            return
+
+    name = context.args[0]
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        await update.message.reply_text(f"Unknown timezone '{name}'. Use a name like Europe/Amsterdam.")
+        return
+    update_chat_info(chat.id, {"timezone": name})
+    await update.message.reply_text(f"🕒 Timezone set to {name}.")
+
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Respond to unknown commands.
@@ -266,35 +329,38 @@ async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE)
     was_member, is_member = result
     if not was_member and is_member:
         chat_id = update.effective_chat.id
-        now = datetime.utcnow()
+        now = datetime.now(timezone.utc)
         chat_info_collection.update_one(
             {"chat_id": chat_id},
             {"$set": {"added_on": now}},
             upsert=True
         )
-        job_queue = context.job_queue
-        job_queue.run_once(send_week_message, when=timedelta(days=7), chat_id=chat_id)
-        job_queue.run_once(send_month_message, when=timedelta(days=30), chat_id=chat_id)
-
-async def send_week_message(context: ContextTypes.DEFAULT_TYPE):
+        # Persisted so the reminders survive restarts; keyed per day to avoid duplicates.
+        day = now.strftime('%Y-%m-%d')
+        scheduler.schedule("week_message", now + timedelta(days=7), chat_id=chat_id,
+                           key=f"week_message:{chat_id}:{day}")
+        scheduler.schedule("month_message", now + timedelta(days=30), chat_id=chat_id,
+                           key=f"month_message:{chat_id}:{day}")
+
+async def send_week_message(bot, job: dict):
     """
-    Send a reminder message after one week.
+    Send a reminder message after one week (scheduled job handler).
     """
-    chat_id = context.job.chat_id
+    chat_id = job["chat_id"]
     text = (
         "Thank you for using this bot, it's totally free for you, but it consumes resources. "
         "If you want to support it, please visit this link: [https://t.ly/m4-av]"
     )
-    await context.bot.send_message(chat_id=chat_id, text=text)
+    await bot.send_message(chat_id=chat_id, text=text)
 
-async def send_month_message(context: ContextTypes.DEFAULT_TYPE):
+async def send_month_message(bot, job: dict):
     """
-    Send a reminder message after one month.
+    Send a reminder message after one month (scheduled job handler).
     """
-    chat_id = context.job.chat_id
+    chat_id = job["chat_id"]
     text = (
         "It's been a month! Thank you for using this bot. "
         "If you'd like to support its development, please visit this link: [https://t.ly/m4-av]"
     )
-    await context.bot.send_message(chat_id=chat_id, text=text)
+    await bot.send_message(chat_id=chat_id, text=text)
 
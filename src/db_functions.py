@@ -1,9 +1,13 @@
 import os
+import json
+import zlib
 import certifi
 import logging
-from pymongo import MongoClient
+from datetime import datetime, timezone
+from bson import Binary
+from pymongo import MongoClient, ASCENDING, DESCENDING
 from pymongo.server_api import ServerApi
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, Optional
 
 # Set up and export the logger.
 logger = logging.getLogger(__name__)
@@ -26,6 +30,25 @@ messages_collection = db["messages"]           # Stores all raw messages.
 memory_collection = db["memory"]               # For any short-term memory data.
 chat_info_collection = db["chat_info"]         # Additional info about chats.
 user_profiles_collection = db["user_profiles"] # Aggregated user profiles per chat.
+scheduled_jobs_collection = db["scheduled_jobs"] # Durable one-off jobs (see scheduler.py).
+daily_digests_collection = db["daily_digests"] # Precomputed per-day summaries (see digests.py).
+worker_leases_collection = db["worker_leases"] # Liveness leases of shard workers (see sharding.py).
+activity_buckets_collection = db["activity_buckets"] # Pre-bucketed activity counts (see activity_analytics.py).
+message_buckets_collection = db["message_buckets"] # Compressed per-chat, per-day archives (see retention.py).
+
+def ensure_message_indexes(collection=None) -> None:
+    """
+    Create the unique (chat_id, message_id) index that makes message inserts idempotent.
+    Fails with an OperationFailure if the collection already holds duplicates.
+
+    Args:
+        collection (Collection): The collection to index; defaults to `messages`.
+    """
+    (messages_collection if collection is None else collection).create_index(
+        [("chat_id", ASCENDING), ("message_id", ASCENDING)],
+        unique=True,
+        name="chat_id_message_id_unique",
+    )
 
 def insert_message(message_data: Dict[str, Any]) -> None:
     """
@@ -108,22 +131,27 @@ def get_statistics_text(chat_id: int) -> str:
         str: A formatted text summary of the chat's statistics, including total messages
              and per-user message counts.
     """
-    total_messages = messages_collection.count_documents({"chat_id": chat_id})
-    user_messages = messages_collection.aggregate([
+    user_messages = {user["_id"]: user for user in messages_collection.aggregate([
         {"$match": {"chat_id": chat_id}},
         {"$group": {
             "_id": "$user_id",
             "count": {"$sum": 1},
             "username": {"$first": "$username"},
             "full_name": {"$first": "$full_name"}
-        }},
-        {"$sort": {"count": -1}}
-    ])
+        }}
+    ])}
+    # Add messages compacted into archive buckets; their names live in user_profiles.
+    names = get_profile_names(chat_id)
+    for user_id, count in get_archived_user_counts(chat_id).items():
+        user = user_messages.setdefault(user_id, {"_id": user_id, "count": 0, **names.get(user_id, {})})
+        user["count"] += count
+    user_messages = sorted(user_messages.values(), key=lambda user: user["count"], reverse=True)
+    total_messages = sum(user["count"] for user in user_messages)
     
     stats_text = f"📊 *Chat Statistics:*\n\nTotal messages: {total_messages}\n\n*User Activity:*\n"
     for user in user_messages:
         username = user.get("username")
-        full_name = user.get("full_name", "Unknown")
+        full_name = user.get("full_name") or "Unknown"
         count = user["count"]
         user_display = f"@{username}" if username else full_name
         stats_text += f"{user_display}: {count} messages\n"
@@ -189,4 +217,127 @@ def get_all_user_messages(chat_id: int, user_id: int) -> List[Dict[str, Any]]:
     Returns:
         List[Dict[str, Any]]: A list of message documents sorted by timestamp.
     """
-    return list(messages_collection.find({"chat_id": chat_id, "user_id": user_id}).sort("timestamp", 1))
+    archived = list(iter_archived_messages(chat_id, user_id=user_id))
+    recent = list(messages_collection.find({"chat_id": chat_id, "user_id": user_id}).sort("timestamp", 1))
+    return archived + recent
+
+# --- Archived Message Buckets ---
+# Messages older than the hot window are compacted by retention.py into one
+# document per chat and UTC day. Rows are stored as zlib-compressed JSON arrays
+# of [message_id, user_id, unix_timestamp, text]; usernames and full names are
+# kept once per user in user_profiles instead of on every message.
+
+def encode_bucket_rows(rows: List[List[Any]]) -> Binary:
+    """
+    Compress bucket rows for storage in a message bucket.
+    """
+    return Binary(zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")))
+
+def decode_bucket_rows(bucket: Dict[str, Any]) -> List[List[Any]]:
+    """
+    Decompress the rows of a message bucket document.
+    """
+    return json.loads(zlib.decompress(bucket["data"]).decode("utf-8"))
+
+def _utc_timestamp(ts: datetime) -> float:
+    """
+    Convert a naive (UTC) or aware datetime to a Unix timestamp.
+    """
+    return (ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts).timestamp()
+
+def get_profile_names(chat_id: int) -> Dict[int, Dict[str, Any]]:
+    """
+    Return the username and full name stored in user_profiles for each user of a chat.
+    """
+    return {
+        profile["user_id"]: {"username": profile.get("username"), "full_name": profile.get("full_name")}
+        for profile in user_profiles_collection.find(
+            {"chat_id": chat_id}, {"user_id": 1, "username": 1, "full_name": 1}
+        )
+    }
+
+def iter_archived_messages(chat_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                           user_id: Optional[int] = None, newest_first: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    Yield archived messages of a chat in the shape of the messages collection.
+    
+    Args:
+        chat_id (int): The chat identifier.
+        start (datetime): Optional inclusive lower bound on the timestamp.
+        end (datetime): Optional exclusive upper bound on the timestamp.
+        user_id (int): Only yield this user's messages.
+        newest_first (bool): Yield in reverse chronological order.
+        
+    Yields:
+        Dict[str, Any]: Message documents with username and full_name from user_profiles.
+    """
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if start:
+        query["last_at"] = {"$gte": start}
+    if end:
+        query["first_at"] = {"$lt": end}
+    if user_id is not None:
+        query["user_counts.user_id"] = user_id
+    lo = _utc_timestamp(start) if start else float("-inf")
+    hi = _utc_timestamp(end) if end else float("inf")
+    names = get_profile_names(chat_id)
+    order = DESCENDING if newest_first else ASCENDING
+    for bucket in message_buckets_collection.find(query).sort("day", order):
+        rows = decode_bucket_rows(bucket)
+        for message_id, row_user_id, ts, text in (reversed(rows) if newest_first else rows):
+            if user_id is not None and row_user_id != user_id:
+                continue
+            if not lo <= ts < hi:
+                continue
+            yield {
+                "message_id": message_id,
+                "chat_id": chat_id,
+                "user_id": row_user_id,
+                **names.get(row_user_id, {"username": None, "full_name": None}),
+                "text": text,
+                # Naive UTC, matching what MongoDB returns for raw messages.
+                "timestamp": datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None),
+            }
+
+def count_archived_messages(chat_id: int, start: Optional[datetime] = None,
+                            end: Optional[datetime] = None) -> int:
+    """
+    Count a chat's archived messages with start <= timestamp < end.
+    
+    Buckets entirely inside the range contribute their stored `count`; only the
+    partially covered first and last days are decompressed.
+    
+    Args:
+        chat_id (int): The chat identifier.
+        start (datetime): Optional inclusive lower bound on the timestamp.
+        end (datetime): Optional exclusive upper bound on the timestamp.
+        
+    Returns:
+        int: The number of archived messages in the range.
+    """
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if start:
+        query["last_at"] = {"$gte": start}
+    if end:
+        query["first_at"] = {"$lt": end}
+    lo = _utc_timestamp(start) if start else float("-inf")
+    hi = _utc_timestamp(end) if end else float("inf")
+    total = 0
+    for bucket in message_buckets_collection.find(query, {"count": 1, "first_at": 1, "last_at": 1}):
+        if lo <= _utc_timestamp(bucket["first_at"]) and _utc_timestamp(bucket["last_at"]) < hi:
+            total += bucket["count"]
+            continue
+        rows = decode_bucket_rows(message_buckets_collection.find_one({"_id": bucket["_id"]}, {"data": 1}))
+        total += sum(1 for row in rows if lo <= row[2] < hi)
+    return total
+
+def get_archived_user_counts(chat_id: int) -> Dict[int, int]:
+    """
+    Return the number of archived messages per user of a chat.
+    """
+    counts = message_buckets_collection.aggregate([
+        {"$match": {"chat_id": chat_id}},
+        {"$unwind": "$user_counts"},
+        {"$group": {"_id": "$user_counts.user_id", "count": {"$sum": "$user_counts.count"}}},
+    ])
+    return {doc["_id"]: doc["count"] for doc in counts}
@@ -0,0 +1,356 @@
+import os
+import asyncio
+import logging
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Any, Dict, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from pymongo import ASCENDING, DESCENDING
+from telegram.ext import ContextTypes
+
+from admission import OverloadedError, Priority
+from ai_functions_lib import AI_ERROR_MESSAGE, _admitted_completion
+from message_cache import message_cache
+from db_functions import (
+    messages_collection,
+    daily_digests_collection,
+    get_chat_info,
+)
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+# Local hour at which a chat's digest for the current day is precomputed.
+DIGEST_HOUR = int(os.getenv("DIGEST_HOUR", "20"))
+# Maximum number of chats summarized at the same time by the batch.
+DIGEST_CONCURRENCY = int(os.getenv("DIGEST_CONCURRENCY", "4"))
+# Seconds between batch runs.
+DIGEST_INTERVAL_SECONDS = int(os.getenv("DIGEST_INTERVAL_SECONDS", "900"))
+# Messages longer than this (in characters) are summarized in chunks first.
+DIGEST_CHUNK_CHARS = int(os.getenv("DIGEST_CHUNK_CHARS", "12000"))
+# Minimum age (seconds) of a stale digest before `/summary` refreshes it in the background.
+DIGEST_REFRESH_SECONDS = int(os.getenv("DIGEST_REFRESH_SECONDS", "600"))
+# Fallback timezone when a chat has none configured (the bot used UTC+1 before).
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "")
+
+SUMMARY_PROMPT = (
+    "Provide a bullet point summary of the following messages from today:\n\n{messages} "
+    "keep it short and structured. You can add some extra formatting suitable for telegram "
+    "messages if that's helpfull try to keep it less than 150 characters "
+)
+CHUNK_PROMPT = (
+    "Summarize the key points of this part of today's chat in a few short bullet points:\n\n{messages}"
+)
+
+
+def chat_timezone(chat_id: int) -> tzinfo:
+    """
+    Return the timezone configured for a chat (`timezone` in chat_info).
+
+    Args:
+        chat_id (int): The chat identifier.
+
+    Returns:
+        tzinfo: The chat's timezone, DEFAULT_TIMEZONE, or UTC+1 as a last resort.
+    """
+    name = get_chat_info(chat_id).get("timezone") or DEFAULT_TIMEZONE
+    if name:
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logger.warning(f"Unknown timezone '{name}' for chat {chat_id}, using UTC+1.")
+    return timezone(timedelta(hours=1))
+
+
+def local_day_bounds(day: date, tz: tzinfo) -> Tuple[datetime, datetime]:
+    """
+    Return the UTC start (inclusive) and end (exclusive) of a local calendar day.
+    """
+    start = datetime(day.year, day.month, day.day, tzinfo=tz)
+    end = datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=tz)
+    return start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+
+
+def _as_utc(ts: datetime) -> datetime:
+    """
+    Treat a naive datetime (as returned by MongoDB) as UTC.
+    """
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+def ensure_indexes() -> None:
+    """
+    Create the indexes used by the digest batch and `/summary` lookups.
+    """
+    daily_digests_collection.create_index([("chat_id", ASCENDING), ("day", ASCENDING)], unique=True)
+    messages_collection.create_index([("chat_id", ASCENDING), ("timestamp", ASCENDING)])
+    messages_collection.create_index([("timestamp", ASCENDING)])
+
+
+def get_stored_digest(chat_id: int, day: date) -> Dict[str, Any]:
+    """
+    Retrieve the stored digest for a chat and local day.
+
+    Returns:
+        Dict[str, Any]: The digest document, or an empty dict if not found.
+    """
+    return daily_digests_collection.find_one({"chat_id": chat_id, "day": day.isoformat()}) or {}
+
+
+def _latest_timestamp(chat_id: int, start: datetime, end: datetime) -> Optional[datetime]:
+    """
+    Return the timestamp of the newest message in the window, if any.
+    """
+    doc = messages_collection.find_one(
+        {"chat_id": chat_id, "timestamp": {"$gte": start, "$lt": end}},
+        {"timestamp": 1},
+        sort=[("timestamp", DESCENDING)],
+    )
+    return doc["timestamp"] if doc else None
+
+
+def is_digest_fresh(digest: Dict[str, Any], chat_id: int, day: date, tz: tzinfo) -> bool:
+    """
+    Check whether a stored digest already covers every message of its day.
+    """
+    if not digest:
+        return False
+    start, end = local_day_bounds(day, tz)
+    latest = _latest_timestamp(chat_id, start, end)
+    return latest is None or latest <= digest["last_message_at"]
+
+
+def _fetch_day_messages(chat_id: int, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+    """
+    Fetch every text message of the window in chronological order, from the
+    in-process ring when it covers the whole window.
+    """
+    cached = message_cache.window(chat_id, start, end)
+    if cached is not None:
+        return cached
+    return list(messages_collection.find(
+        {"chat_id": chat_id, "timestamp": {"$gte": start, "$lt": end}},
+        {"text": 1, "timestamp": 1},
+    ).sort("timestamp", ASCENDING))
+
+
+def _chunk_texts(texts: List[str], max_chars: int) -> List[str]:
+    """
+    Group message texts into newline-joined chunks of at most `max_chars` characters.
+    """
+    chunks, current, size = [], [], 0
+    for text in texts:
+        if current and size + len(text) > max_chars:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(text)
+        size += len(text) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+async def summarize_texts(texts: List[str], priority: Priority) -> str:
+    """
+    Summarize a full day of messages, condensing long days chunk by chunk first.
+
+    Args:
+        texts (List[str]): Message texts in chronological order.
+        priority (Priority): Admission tier for the OpenAI calls.
+
+    Returns:
+        str: The bullet-point summary.
+
+    Raises:
+        OverloadedError: If one of the requests was shed.
+        RuntimeError: If one of the OpenAI requests failed.
+    """
+    chunks = _chunk_texts(texts, DIGEST_CHUNK_CHARS)
+    if len(chunks) > 1:
+        partials = []
+        for chunk in chunks:
+            messages = [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": CHUNK_PROMPT.format(messages=chunk)},
+            ]
+            partial = await _admitted_completion(messages, 200, 0.5, priority)
+            if partial == AI_ERROR_MESSAGE:
+                # The apology would end up in the final prompt and the stored digest.
+                raise RuntimeError("OpenAI request failed while summarizing a chunk of the day")
+            partials.append(partial)
+        body = "\n".join(partials)
+    else:
+        body = chunks[0]
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": SUMMARY_PROMPT.format(messages=body)},
+    ]
+    summary = await _admitted_completion(messages, 200, 0.7, priority)
+    if summary == AI_ERROR_MESSAGE:
+        raise RuntimeError("OpenAI request failed while building the digest")
+    return summary
+
+
+async def build_digest(chat_id: int, day: date, tz: tzinfo, priority: Priority = Priority.SCHEDULED,
+                       now: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Compute and store the digest of a chat's local day.
+
+    Args:
+        chat_id (int): The chat identifier.
+        day (date): The local calendar day to summarize.
+        tz (tzinfo): The chat's timezone.
+        priority (Priority): Admission tier for the OpenAI calls.
+        now (datetime): Generation time recorded on the digest; defaults to the current time.
+
+    Returns:
+        Dict[str, Any]: The stored digest, or an empty dict if the day has no messages.
+
+    Raises:
+        OverloadedError: If the summary request was shed.
+        RuntimeError: If the OpenAI request failed.
+    """
+    start, end = local_day_bounds(day, tz)
+    docs = _fetch_day_messages(chat_id, start, end)
+    texts = [doc["text"] for doc in docs if doc.get("text")]
+    if not texts:
+        return {}
+
+    # Raises on a failed generation, so it is never cached; the next run retries it.
+    summary = await summarize_texts(texts, priority)
+    digest = {
+        "chat_id": chat_id,
+        "day": day.isoformat(),
+        "summary": summary,
+        "message_count": len(texts),
+        "last_message_at": docs[-1]["timestamp"],
+        "generated_at": now or datetime.now(timezone.utc),
+    }
+    daily_digests_collection.update_one(
+        {"chat_id": chat_id, "day": digest["day"]},
+        {"$set": digest},
+        upsert=True,
+    )
+    return digest
+
+
+# Chat-days whose digest is being refreshed in the background.
+_refreshing: Set[Tuple[int, str]] = set()
+
+
+def refresh_due(digest: Dict[str, Any], chat_id: int, day: date, tz: tzinfo,
+                now: Optional[datetime] = None) -> bool:
+    """
+    Decide whether `/summary` should refresh the stored digest it serves: it
+    must miss newer messages and be at least DIGEST_REFRESH_SECONDS old, so an
+    active chat doesn't trigger a multi-call rebuild on every command.
+    """
+    if not digest or (chat_id, day.isoformat()) in _refreshing:
+        return False
+    now = now or datetime.now(timezone.utc)
+    if now - _as_utc(digest["generated_at"]) < timedelta(seconds=DIGEST_REFRESH_SECONDS):
+        return False
+    return not is_digest_fresh(digest, chat_id, day, tz)
+
+
+async def refresh_digest(chat_id: int, day: date, tz: tzinfo) -> None:
+    """
+    Rebuild a digest in the background at SCHEDULED priority. At most one
+    refresh per chat and day runs at a time; failures keep the stored digest.
+    """
+    key = (chat_id, day.isoformat())
+    if key in _refreshing:
+        return
+    _refreshing.add(key)
+    try:
+        await build_digest(chat_id, day, tz, Priority.SCHEDULED)
+    except (OverloadedError, RuntimeError) as e:
+        logger.warning(f"Background digest refresh for chat {chat_id} failed: {e}")
+    finally:
+        _refreshing.discard(key)
+
+
+def _due_days(tz: tzinfo, now: datetime) -> List[date]:
+    """
+    Return the local days whose digest should exist at `now`: yesterday always
+    (so a missed evening is caught up) and today once DIGEST_HOUR has passed.
+    """
+    local_now = now.astimezone(tz)
+    days = [local_now.date() - timedelta(days=1)]
+    if local_now.hour >= DIGEST_HOUR:
+        days.append(local_now.date())
+    return days
+
+
+def _needs_build(digest: Dict[str, Any], chat_id: int, day: date, tz: tzinfo, now: datetime) -> bool:
+    """
+    Decide whether the batch should (re)compute a day's digest.
+
+    A day is computed once at DIGEST_HOUR and once more after it ends if later
+    messages made it stale; a digest generated after the day ended is final.
+    Later messages of the current day are picked up by `/summary` on demand.
+    """
+    if not digest:
+        return True
+    _, end = local_day_bounds(day, tz)
+    if _as_utc(digest["generated_at"]) >= end or now < end:
+        return False
+    return not is_digest_fresh(digest, chat_id, day, tz)
+
+
+async def _digest_chat(chat_id: int, now: datetime, semaphore: asyncio.Semaphore) -> int:
+    """
+    Bring a single chat's due digests up to date.
+
+    Returns:
+        int: The number of digests (re)computed.
+    """
+    async with semaphore:
+        tz = chat_timezone(chat_id)
+        built = 0
+        for day in _due_days(tz, now):
+            if not _needs_build(get_stored_digest(chat_id, day), chat_id, day, tz, now):
+                continue
+            if await build_digest(chat_id, day, tz, now=now):
+                built += 1
+        return built
+
+
+async def run_digest_batch(now: Optional[datetime] = None) -> int:
+    """
+    Precompute digests for every chat with messages in the last two days.
+
+    Chats are processed with bounded concurrency. Each day is summarized at
+    most twice (at DIGEST_HOUR and after the day ends), and days already
+    stored are skipped, so a failed or interrupted run resumes where it left
+    off on the next invocation.
+
+    Args:
+        now (datetime): The reference time (UTC); defaults to the current time.
+
+    Returns:
+        int: The number of digests computed.
+    """
+    now = now or datetime.now(timezone.utc)
+    chat_ids = messages_collection.distinct("chat_id", {"timestamp": {"$gte": now - timedelta(days=2)}})
+    semaphore = asyncio.Semaphore(DIGEST_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_digest_chat(chat_id, now, semaphore) for chat_id in chat_ids),
+        return_exceptions=True,
+    )
+    built = 0
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Digest for chat {chat_id} failed: {result}")
+        else:
+            built += result
+    return built
+
+
+async def digest_sweep(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job-queue callback that runs the digest batch; register with `run_repeating`.
+    """
+    built = await run_digest_batch()
+    if built:
+        logger.info(f"Computed {built} daily digest(s).")
@@ -0,0 +1,477 @@
+"""
+Bulk import and export of chat history for the `messages` collection.
+
+    python src/history_tool.py import result.json [--chat-id ID] [--batch-size N] [--dry-run]
+    python src/history_tool.py export CHAT_ID out.jsonl.gz [--since DATE] [--until DATE]
+    python src/history_tool.py export CHAT_ID out.parquet --format parquet
+    python src/history_tool.py synth big_export.json --messages 20000000
+    python src/history_tool.py bench big_export.json [--collection NAME] [--keep]
+
+`import` stream-parses a Telegram Desktop JSON export ("Export chat history",
+machine-readable JSON) without loading it into memory. `synth` writes a large
+synthetic export; `import --dry-run` measures parser throughput on its own,
+and `bench` measures the whole import, batched unordered inserts included,
+into a scratch collection that is dropped afterwards.
+"""
+import re
+import sys
+import gzip
+import json
+import time
+import codecs
+import itertools
+import random
+import argparse
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+load_dotenv()
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_BYTES = 1 << 20
+DEFAULT_BATCH_SIZE = 1000
+
+_MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+_HEADER_ID = re.compile(r'"id"\s*:\s*(-?\d+)')
+_HEADER_TYPE = re.compile(r'"type"\s*:\s*"([a-z_]+)"')
+_WHITESPACE_AND_COMMAS = re.compile(r'[\s,]*')
+
+
+# ---------------------------------------------------------------------
+# Telegram Desktop export parsing
+# ---------------------------------------------------------------------
+def bot_api_chat_id(export_id: int, export_type: str) -> int:
+    """
+    Convert the chat id found in a Telegram Desktop export to the Bot API id
+    stored in `chat_id` (supergroups and channels are prefixed with -100).
+    """
+    if export_type in ("private_supergroup", "public_supergroup", "private_channel", "public_channel"):
+        return -int(f"100{export_id}")
+    if export_type == "private_group":
+        return -export_id
+    return export_id
+
+
+class ExportReader:
+    """
+    Incrementally parses the `messages` array of a Telegram Desktop export.
+
+    The file is read in fixed-size chunks and each message object is decoded
+    with `json.JSONDecoder.raw_decode` as soon as it is complete, so memory use
+    is bounded by the chunk size plus the largest single message.
+    """
+
+    def __init__(self, path: str, chunk_bytes: int = READ_CHUNK_BYTES):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.bytes_read = 0
+        self.header: Dict[str, Any] = {}
+        self._decoder = json.JSONDecoder()
+
+    def _read(self, stream, utf8) -> Optional[str]:
+        """
+        Read and decode the next chunk, or return None at the end of the file.
+        A chunk ending inside a multi-byte character may decode to "".
+        """
+        data = stream.read(self.chunk_bytes)
+        self.bytes_read += len(data)
+        if not data:
+            utf8.decode(b"", final=True)
+            return None
+        return utf8.decode(data)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        with open(self.path, "rb") as stream:
+            buffer = ""
+            # Scan the top-level scalars (name, type, id) that precede the messages.
+            while True:
+                match = _MESSAGES_KEY.search(buffer)
+                if match:
+                    break
+                chunk = self._read(stream, utf8)
+                if chunk is None:
+                    raise ValueError(f"{self.path} has no top-level 'messages' array.")
+                buffer += chunk
+            head = buffer[:match.start()]
+            id_match, type_match = _HEADER_ID.search(head), _HEADER_TYPE.search(head)
+            self.header = {
+                "id": int(id_match.group(1)) if id_match else None,
+                "type": type_match.group(1) if type_match else None,
+            }
+
+            buffer, pos = buffer[match.end():], 0
+            while True:
+                pos = _WHITESPACE_AND_COMMAS.match(buffer, pos).end()
+                if pos < len(buffer) and buffer[pos] == "]":
+                    return
+                try:
+                    message, end = self._decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    chunk = self._read(stream, utf8)
+                    if chunk is None:
+                        raise ValueError(f"{self.path} ended in the middle of the messages array.")
+                    buffer, pos = buffer[pos:] + chunk, 0
+                    continue
+                pos = end
+                yield message
+
+
+def _flatten_text(text: Any) -> str:
+    """
+    Join the plain and formatted entities of an export `text` field.
+    """
+    if isinstance(text, str):
+        return text
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return ""
+
+
+def export_message_to_doc(message: Dict[str, Any], chat_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Convert an exported message to the document shape written by `insert_message`.
+
+    Args:
+        message (Dict[str, Any]): A message object from the export.
+        chat_id (int): The Bot API chat id to store.
+
+    Returns:
+        Optional[Dict[str, Any]]: The message document, or None for service
+                                  messages, non-user senders and messages without text.
+    """
+    if message.get("type") != "message":
+        return None
+    text = _flatten_text(message.get("text"))
+    from_id = message.get("from_id") or ""
+    if not text or not from_id.startswith("user"):
+        return None
+    if "date_unixtime" in message:
+        timestamp = datetime.fromtimestamp(int(message["date_unixtime"]), timezone.utc)
+    else:
+        timestamp = datetime.fromisoformat(message["date"]).replace(tzinfo=timezone.utc)
+    return {
+        "message_id": message["id"],
+        "chat_id": chat_id,
+        "user_id": int(from_id[len("user"):]),
+        "username": None,  # Exports only contain display names.
+        "full_name": message.get("from"),
+        "text": text,
+        "timestamp": timestamp,
+    }
+
+
+# ---------------------------------------------------------------------
+# Import
+# ---------------------------------------------------------------------
+def _insert_batch(batch: List[Dict[str, Any]], collection: Any) -> Tuple[int, int]:
+    """
+    Insert a batch unordered, counting documents skipped as duplicates.
+
+    Returns:
+        Tuple[int, int]: (inserted, duplicates)
+    """
+    from pymongo.errors import BulkWriteError
+    try:
+        result = collection.insert_many(batch, ordered=False)
+        return len(result.inserted_ids), 0
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        duplicates = sum(1 for error in errors if error.get("code") == 11000)
+        if duplicates != len(errors):
+            raise
+        return e.details.get("nInserted", 0), duplicates
+
+
+def _archived_message_ids(chat_id: int, day: datetime) -> Set[int]:
+    """
+    Return the message ids already compacted into a chat-day's archive bucket.
+    """
+    from db_functions import message_buckets_collection, decode_bucket_rows
+    bucket = message_buckets_collection.find_one({"chat_id": chat_id, "day": day}, {"data": 1})
+    return {row[0] for row in decode_bucket_rows(bucket)} if bucket else set()
+
+
+def _file_size(path: str) -> int:
+    with open(path, "rb") as stream:
+        return stream.seek(0, 2)
+
+
+def import_export(path: str, chat_id: Optional[int] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                  dry_run: bool = False, collection: Any = None) -> Dict[str, Any]:
+    """
+    Stream a Telegram Desktop export into the messages collection.
+
+    Args:
+        path (str): Path to the export's JSON file.
+        chat_id (int): Bot API chat id; derived from the export header if omitted.
+        batch_size (int): Documents per `insert_many` call.
+        dry_run (bool): Parse and convert only, without touching the database.
+        collection (Collection): Target collection; defaults to `messages`.
+
+    Returns:
+        Dict[str, Any]: Counters for parsed, skipped, inserted and duplicate messages;
+                        imports into `messages` also rebuild the chat's activity buckets.
+                        Messages already compacted by retention.py count as duplicates.
+    """
+    from db_functions import messages_collection, ensure_message_indexes
+    if collection is None:
+        collection = messages_collection
+    if not dry_run:
+        ensure_message_indexes(collection)
+
+    reader = ExportReader(path)
+    stats = {"parsed": 0, "skipped": 0, "inserted": 0, "duplicates": 0}
+    batch: List[Dict[str, Any]] = []
+    # Ids in the archive bucket of the UTC day last seen; exports are in date order.
+    archived: Dict[str, Any] = {"day": None, "ids": set()}
+    started = time.monotonic()
+
+    def is_archived(doc: Dict[str, Any]) -> bool:
+        # Compacted messages are gone from `messages`, so its unique index can't catch them.
+        if dry_run or collection is not messages_collection:
+            return False
+        day = doc["timestamp"].replace(hour=0, minute=0, second=0, microsecond=0)
+        if day != archived["day"]:
+            archived.update(day=day, ids=_archived_message_ids(chat_id, day))
+        return doc["message_id"] in archived["ids"]
+
+    def flush() -> None:
+        if batch and not dry_run:
+            inserted, duplicates = _insert_batch(batch, collection)
+            stats["inserted"] += inserted
+            stats["duplicates"] += duplicates
+        batch.clear()
+
+    with tqdm(total=_file_size(path), unit="B", unit_scale=True, desc="import") as progress:
+        for message in reader:
+            if chat_id is None:
+                if reader.header.get("id") is None:
+                    raise ValueError("The export header has no chat id; pass --chat-id.")
+                chat_id = bot_api_chat_id(reader.header["id"], reader.header.get("type") or "")
+            stats["parsed"] += 1
+            doc = export_message_to_doc(message, chat_id)
+            if doc is None:
+                stats["skipped"] += 1
+            elif is_archived(doc):
+                stats["duplicates"] += 1
+            else:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    flush()
+            progress.update(reader.bytes_read - progress.n)
+        flush()
+        progress.update(reader.bytes_read - progress.n)
+
+    elapsed = time.monotonic() - started
+    stats.update(chat_id=chat_id, seconds=round(elapsed, 2),
+                 messages_per_second=round(stats["parsed"] / elapsed) if elapsed else None,
+                 mb_per_second=round(reader.bytes_read / elapsed / 1e6, 1) if elapsed else None)
+    if not dry_run and collection is messages_collection and stats["inserted"]:
+        # Count the imported history in the activity buckets behind /stats and /activity.
+        from activity_analytics import rebuild_activity
+        stats["activity_messages"] = rebuild_activity(chat_id)
+    return stats
+
+
+def benchmark_import(path: str, collection_name: str = "import_benchmark", batch_size: int = DEFAULT_BATCH_SIZE,
+                     keep: bool = False) -> Dict[str, Any]:
+    """
+    Measure end-to-end import throughput into a scratch collection.
+
+    Args:
+        path (str): Path to the export's JSON file, e.g. one written by `synth`.
+        collection_name (str): Scratch collection in the bot's database; emptied first.
+        batch_size (int): Documents per `insert_many` call.
+        keep (bool): Keep the scratch collection instead of dropping it.
+
+    Returns:
+        Dict[str, Any]: The import counters, messages/s and MB/s.
+    """
+    from db_functions import db
+    if collection_name == "messages":
+        raise ValueError("Refusing to benchmark against the live messages collection.")
+    collection = db[collection_name]
+    collection.drop()
+    try:
+        stats = import_export(path, batch_size=batch_size, collection=collection)
+    finally:
+        if not keep:
+            collection.drop()
+    stats.update(collection=collection_name, batch_size=batch_size)
+    return stats
+
+
+# ---------------------------------------------------------------------
+# Export
+# ---------------------------------------------------------------------
+EXPORT_FIELDS = ["message_id", "chat_id", "user_id", "username", "full_name", "text", "timestamp"]
+
+
+def _range_query(chat_id: int, since: Optional[datetime], until: Optional[datetime]) -> Dict[str, Any]:
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    bounds = {op: value for op, value in (("$gte", since), ("$lt", until)) if value}
+    if bounds:
+        query["timestamp"] = bounds
+    return query
+
+
+def export_chat(chat_id: int, path: str, fmt: str = "jsonl", since: Optional[datetime] = None,
+                until: Optional[datetime] = None, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Stream a chat's messages to gzip-compressed JSONL or to Parquet.
+
+    Args:
+        chat_id (int): The chat identifier.
+        path (str): Output file path.
+        fmt (str): "jsonl" (gzip-compressed) or "parquet" (requires pyarrow).
+        since (datetime): Optional inclusive lower bound on the timestamp.
+        until (datetime): Optional exclusive upper bound on the timestamp.
+        batch_size (int): Cursor batch size and Parquet row-group size.
+
+    Returns:
+        int: The number of exported messages.
+    """
+    from db_functions import messages_collection
+    query = _range_query(chat_id, since, until)
+    projection = {field: 1 for field in EXPORT_FIELDS}
+    projection["_id"] = 0
+    from db_functions import count_archived_messages, iter_archived_messages
+    total = messages_collection.count_documents(query) + count_archived_messages(chat_id, since, until)
+    # Messages compacted by retention.py come first; they are older than any raw one.
+    archived = ({field: doc[field] for field in EXPORT_FIELDS}
+                for doc in iter_archived_messages(chat_id, since, until))
+    cursor = itertools.chain(
+        archived, messages_collection.find(query, projection).sort("timestamp", 1).batch_size(batch_size)
+    )
+
+    count = 0
+    with tqdm(total=total, unit="msg", desc="export") as progress:
+        if fmt == "jsonl":
+            with gzip.open(path, "wt", encoding="utf-8") as out:
+                for doc in cursor:
+                    doc["timestamp"] = doc["timestamp"].replace(tzinfo=timezone.utc).isoformat()
+                    out.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                    count += 1
+                    progress.update(1)
+        elif fmt == "parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise SystemExit("Parquet export requires pyarrow: pip install pyarrow")
+            schema = pa.schema([
+                ("message_id", pa.int64()), ("chat_id", pa.int64()), ("user_id", pa.int64()),
+                ("username", pa.string()), ("full_name", pa.string()), ("text", pa.string()),
+                ("timestamp", pa.timestamp("ms", tz="UTC")),
+            ])
+            with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+                rows: List[Dict[str, Any]] = []
+                for doc in cursor:
+                    rows.append(doc)
+                    if len(rows) >= batch_size:
+                        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                        count += len(rows)
+                        progress.update(len(rows))
+                        rows = []
+                if rows:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                    count += len(rows)
+                    progress.update(len(rows))
+        else:
+            raise ValueError(f"Unknown export format: {fmt}")
+    return count
+
+
+# ---------------------------------------------------------------------
+# Synthetic exports
+# ---------------------------------------------------------------------
+_WORDS = ("hello", "lunch", "meeting", "tomorrow", "bot", "python", "coffee", "weekend",
+          "deploy", "photo", "music", "game", "tonight", "thanks", "ok", "lol")
+
+
+def write_synthetic_export(path: str, messages: int, users: int = 500, seed: int = 0) -> None:
+    """
+    Write a Telegram Desktop style export with `messages` random messages.
+    """
+    rng = random.Random(seed)
+    start = int(datetime(2023, 1, 1, tzinfo=timezone.utc).timestamp())
+    with open(path, "w", encoding="utf-8") as out:
+        out.write('{\n "name": "Synthetic chat",\n "type": "private_supergroup",\n "id": 1234567890,\n "messages": [\n')
+        for message_id in range(1, messages + 1):
+            user = rng.randrange(users)
+            ts = start + message_id * 7
+            words = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 25)))
+            text = words if message_id % 5 else [words, {"type": "bold", "text": " wow"}]
+            message = {
+                "id": message_id, "type": "message",
+                "date": datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
+                "date_unixtime": str(ts), "from": f"User {user}", "from_id": f"user{1000 + user}",
+                "text": text,
+            }
+            out.write(("  " if message_id == 1 else ",\n  ") + json.dumps(message, ensure_ascii=False))
+        out.write("\n ]\n}\n")
+
+
+# ---------------------------------------------------------------------
+# Command line
+# ---------------------------------------------------------------------
+def _parse_date(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Import and export chat history.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="Import a Telegram Desktop JSON export.")
+    importer.add_argument("path")
+    importer.add_argument("--chat-id", type=int, help="Bot API chat id (defaults to the export's id).")
+    importer.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    importer.add_argument("--dry-run", action="store_true", help="Parse only, don't write to MongoDB.")
+
+    exporter = commands.add_parser("export", help="Export a chat's messages.")
+    exporter.add_argument("chat_id", type=int)
+    exporter.add_argument("path")
+    exporter.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    exporter.add_argument("--since", type=_parse_date, help="ISO date/time, inclusive.")
+    exporter.add_argument("--until", type=_parse_date, help="ISO date/time, exclusive.")
+    exporter.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+
+    synth = commands.add_parser("synth", help="Write a synthetic export for benchmarking.")
+    synth.add_argument("path")
+    synth.add_argument("--messages", type=int, default=1_000_000)
+    synth.add_argument("--users", type=int, default=500)
+
+    bench = commands.add_parser("bench", help="Measure import throughput into a scratch collection.")
+    bench.add_argument("path")
+    bench.add_argument("--collection", default="import_benchmark")
+    bench.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    bench.add_argument("--keep", action="store_true", help="Don't drop the scratch collection afterwards.")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "import":
+        stats = import_export(args.path, args.chat_id, args.batch_size, args.dry_run)
+        print(json.dumps(stats, indent=2))
+    elif args.command == "export":
+        count = export_chat(args.chat_id, args.path, args.format, args.since, args.until, args.batch_size)
+        print(f"Exported {count} messages to {args.path}")
+    elif args.command == "bench":
+        stats = benchmark_import(args.path, args.collection, args.batch_size, args.keep)
+        print(json.dumps(stats, indent=2))
+    elif args.command == "synth":
+        write_synthetic_export(args.path, args.messages, args.users)
+        print(f"Wrote {args.messages} messages to {args.path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
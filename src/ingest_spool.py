@@ -0,0 +1,243 @@
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from telegram.ext import ContextTypes
+
+from db_functions import insert_message, messages_collection
+from activity_analytics import record_activity
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+# Where the spool lives; shared by all processes of a deployment on this host.
+SPOOL_PATH = os.getenv("SPOOL_PATH", "ingest_spool.db")
+# A primary insert slower than this (seconds) is abandoned and spooled instead.
+INSERT_LATENCY_BUDGET = float(os.getenv("INSERT_LATENCY_BUDGET", "0.5"))
+# After a failure, skip the primary for this many seconds and spool directly.
+PRIMARY_COOLDOWN_SECONDS = float(os.getenv("PRIMARY_COOLDOWN_SECONDS", "10"))
+DRAIN_BATCH_SIZE = int(os.getenv("SPOOL_DRAIN_BATCH", "500"))
+DRAIN_INTERVAL_SECONDS = int(os.getenv("SPOOL_DRAIN_SECONDS", "5"))
+
+# Outcomes of IngestSpool.store().
+STORED = "stored"
+SPOOLED = "spooled"
+
+
+class IngestSpool:
+    """
+    Write-ahead spool that keeps message ingestion working while MongoDB is
+    slow or unreachable.
+
+    Messages are inserted into MongoDB directly while it answers within the
+    latency budget. On a timeout or error, and for as long as the spool still
+    holds a backlog, they are appended to a local SQLite database in WAL mode
+    instead. `drain` replays the backlog in batches once MongoDB recovers.
+    Every document gets its `_id` before the first attempt, so a replay of a
+    message that did reach MongoDB is recognised as a duplicate and skipped.
+    `on_stored` runs exactly once per message, including for an abandoned
+    insert that still completes after its message was spooled.
+    """
+
+    def __init__(self, path: str = SPOOL_PATH, latency_budget: float = INSERT_LATENCY_BUDGET,
+                 cooldown: float = PRIMARY_COOLDOWN_SECONDS, batch_size: int = DRAIN_BATCH_SIZE,
+                 on_stored: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 clock: Callable[[], float] = time.time):
+        """
+        Args:
+            path (str): SQLite file backing the spool.
+            latency_budget (float): Seconds a direct insert may take before it is spooled.
+            cooldown (float): Seconds to bypass MongoDB after a failed insert.
+            batch_size (int): Documents replayed per `insert_many`.
+            on_stored (Callable): Called with each document once it is in MongoDB.
+            clock (Callable[[], float]): Wall clock, injectable for tests.
+        """
+        self.path = path
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.batch_size = batch_size
+        self.on_stored = on_stored
+        self.clock = clock
+        self.bypass_until = 0.0
+        self.counters = {"stored": 0, "late_stored": 0, "spooled": 0, "drained": 0, "duplicates": 0, "dropped": 0}
+        self._conn: Optional[sqlite3.Connection] = None
+        # The connection is shared by the event loop and the drain thread.
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # NORMAL is crash-safe in WAL mode: committed rows survive a process crash.
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " enqueued_at REAL NOT NULL,"
+                " doc TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def append(self, doc: Dict[str, Any]) -> None:
+        """
+        Durably append a message document to the spool.
+        """
+        # Without an `_id`, a replay after a crash could not be told apart from a new message.
+        doc.setdefault("_id", ObjectId())
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO spool (enqueued_at, doc) VALUES (?, ?)",
+                (self.clock(), json_util.dumps(doc)),
+            )
+        self.counters["spooled"] += 1
+
+    def has_backlog(self) -> bool:
+        """
+        Return True if spooled messages are waiting to be drained.
+        """
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM spool LIMIT 1").fetchone() is not None
+
+    def _stored(self, doc: Dict[str, Any]) -> None:
+        if self.on_stored is not None:
+            try:
+                self.on_stored(doc)
+            except Exception as e:
+                logger.error(f"Post-insert hook failed for message {doc.get('message_id')}: {e}")
+
+    def _insert(self, doc: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """
+        Insert into MongoDB and run the post-insert hook, from a worker thread
+        so neither blocks the event loop. The hook also runs if `store` has
+        given up on the insert in the meantime: the message was spooled as well
+        and its replay will be a duplicate.
+        """
+        insert_message(doc)
+        with state["lock"]:
+            state["done"] = True
+            abandoned = state["abandoned"]
+        if abandoned:
+            self.counters["late_stored"] += 1
+        self._stored(doc)
+
+    async def store(self, doc: Dict[str, Any]) -> str:
+        """
+        Store a message in MongoDB, or in the spool if MongoDB is too slow or failing.
+
+        Args:
+            doc (Dict[str, Any]): The message document for `insert_message`.
+
+        Returns:
+            str: STORED if the message is in MongoDB, SPOOLED if it was spooled.
+        """
+        doc.setdefault("_id", ObjectId())
+        # Keep arrival order: while a backlog exists, new messages queue behind it.
+        if self.clock() < self.bypass_until or self.has_backlog():
+            self.append(doc)
+            return SPOOLED
+        # The thread keeps running after a timeout; `state` tells whether the
+        # insert itself finished, in which case only the hook is still running.
+        state = {"lock": threading.Lock(), "done": False, "abandoned": False}
+        try:
+            await asyncio.wait_for(asyncio.to_thread(self._insert, doc, state), self.latency_budget)
+        except DuplicateKeyError:
+            return STORED
+        except (asyncio.TimeoutError, PyMongoError) as e:
+            with state["lock"]:
+                state["abandoned"] = True
+                done = state["done"]
+            if not done:
+                logger.warning(f"Spooling message {doc.get('message_id')}: primary insert failed ({e!r})")
+                self.bypass_until = self.clock() + self.cooldown
+                self.append(doc)
+                return SPOOLED
+        self.counters["stored"] += 1
+        return STORED
+
+    def _insert_batch(self, docs: List[Dict[str, Any]]) -> None:
+        """
+        Insert a replay batch, treating duplicates as already stored.
+        """
+        failed = set()
+        try:
+            messages_collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed.add(error["index"])
+                if error.get("code") == 11000:
+                    self.counters["duplicates"] += 1
+                else:
+                    # Permanent rejections (e.g. validation) would block the spool forever.
+                    self.counters["dropped"] += 1
+                    logger.error(f"Dropping spooled message {docs[error['index']].get('message_id')}: "
+                                 f"{error.get('errmsg')}")
+        for index, doc in enumerate(docs):
+            if index not in failed:
+                self.counters["drained"] += 1
+                self._stored(doc)
+
+    def drain_once(self) -> int:
+        """
+        Replay one batch from the spool into MongoDB and delete it locally.
+
+        Returns:
+            int: The number of spool rows processed.
+
+        Raises:
+            PyMongoError: If MongoDB is still unavailable; the batch stays spooled.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, doc FROM spool ORDER BY id LIMIT ?", (self.batch_size,)
+            ).fetchall()
+        if not rows:
+            return 0
+        self._insert_batch([json_util.loads(doc) for _, doc in rows])
+        # Deleting only after the insert makes a crash in between replay-safe.
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM spool WHERE id <= ?", (rows[-1][0],))
+        return len(rows)
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Return spool size, drain lag and counters.
+        """
+        with self._lock:
+            rows, size, oldest = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(doc)), 0), MIN(enqueued_at) FROM spool"
+            ).fetchone()
+        return {
+            **self.counters,
+            "backlog": rows,
+            "backlog_bytes": size,
+            "drain_lag_seconds": round(self.clock() - oldest, 1) if oldest else 0.0,
+        }
+
+    async def drain(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Job-queue callback that drains the spool until it is empty or MongoDB fails.
+        """
+        drained = 0
+        try:
+            while True:
+                count = await asyncio.to_thread(self.drain_once)
+                if not count:
+                    break
+                drained += count
+        except PyMongoError as e:
+            logger.warning(f"Spool drain paused, MongoDB unavailable: {e}")
+            self.bypass_until = self.clock() + self.cooldown
+        if drained:
+            logger.info(f"Drained {drained} spooled message(s): {self.metrics()}")
+
+
+# Shared spool; stored messages also feed the activity buckets.
+ingest_spool = IngestSpool(on_stored=record_activity)
@@ -27,10 +27,19 @@ from command_handlers import (
     unknown_command,
     statistics_command,
     help_command,
-    message_handler
-    #send in a month message
-    #send in a week message
+    timezone_command,
+    message_handler,
+    send_week_message,
+    send_month_message,
 )
+from scheduler import scheduler, SWEEP_INTERVAL_SECONDS
+import digests
+import activity_analytics
+import retention
+from message_cache import message_cache
+from ingest_spool import ingest_spool, DRAIN_INTERVAL_SECONDS
+from db_functions import ensure_message_indexes
+from pymongo.errors import OperationFailure
 
 from stats_handlers import send_activity_chart
 from utils import extract_status_change  # if needed elsewhere
@@ -46,12 +55,19 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("The Telegram bot token is not set. Please set the BOT_TOKEN environment variable.")
 
+# Number of worker processes; values above 1 enable sharding by chat.
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
 
 
 
 
-def main():
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+
+def build_application(token: str):
+    """
+    Build the Telegram application with every update handler registered.
+    Used by the single-process bot, the sharding front and each shard worker.
+    """
+    application = ApplicationBuilder().token(token).build()
     
     # Command handlers
     application.add_handler(CommandHandler('profile', profile_command))  
@@ -62,6 +78,7 @@ def main():
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('topic', topic_command))
     application.add_handler(CommandHandler('start', start_command))  
+    application.add_handler(CommandHandler('timezone', timezone_command))
     application.add_handler(CommandHandler("activity", send_activity_chart))  # sends pie chart
 
     # Callback query handler
@@ -69,13 +86,54 @@ def main():
     application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
     application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), message_handler))
+
+    # Each process keeps its own recent-message cache; log its metrics periodically.
+    application.job_queue.run_repeating(message_cache.log_metrics, interval=600, first=600)
+    return application
+
+
+def register_background_jobs(application) -> None:
+    """
+    Schedule the periodic background jobs. Only one process per deployment
+    (the single bot process or the sharding front) should run these.
+    """
+    # Durable scheduled jobs (reminders) are swept from MongoDB.
+    scheduler.ensure_indexes()
+    scheduler.register("week_message", send_week_message)
+    scheduler.register("month_message", send_month_message)
+    application.job_queue.run_repeating(scheduler.sweep, interval=SWEEP_INTERVAL_SECONDS, first=0)
+
+    # Daily digests are precomputed per chat so /summary can answer instantly.
+    digests.ensure_indexes()
+    application.job_queue.run_repeating(digests.digest_sweep, interval=digests.DIGEST_INTERVAL_SECONDS, first=60)
+
+    # Hourly/daily activity buckets back /activity heatmap|trend and /stats week.
+    activity_analytics.ensure_indexes()
+
+    # Messages spooled locally while MongoDB was unavailable are replayed here.
+    try:
+        ensure_message_indexes()
+    except OperationFailure as e:
+        logger.warning(f"Unique message index not created, spool replays may duplicate messages: {e}")
+    application.job_queue.run_repeating(ingest_spool.drain, interval=DRAIN_INTERVAL_SECONDS, first=0)
+
+    # Optionally roll messages older than the hot window into compressed buckets.
+    if retention.RETENTION_ENABLED:
+        retention.ensure_indexes()
+        application.job_queue.run_repeating(retention.compaction_job, interval=3600, first=300)
+
+
+def main():
+    if BOT_WORKERS > 1:
+        # Route updates by chat to a pool of worker processes (see sharding.py).
+        from sharding import run_sharded
+        run_sharded(BOT_TOKEN, BOT_WORKERS, build_application, register_background_jobs)
+        return
+
+    application = build_application(BOT_TOKEN)
+    register_background_jobs(application)
     application.run_polling(timeout=10)
 
 
 if __name__ == '__main__':
     main()
-    
-    
-
-
-    
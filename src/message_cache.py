@@ -0,0 +1,319 @@
+import os
+import sys
+import logging
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from telegram.ext import ContextTypes
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+# Messages kept per chat and the global memory budget for all chats.
+MESSAGES_PER_CHAT = int(os.getenv("MESSAGE_CACHE_PER_CHAT", "500"))
+MAX_CACHE_BYTES = int(os.getenv("MESSAGE_CACHE_MB", "64")) * 1024 * 1024
+# Fixed per-slot cost: three 8-byte array items plus three list pointers.
+_SLOT_BYTES = 6 * 8
+
+Loader = Callable[[int, int], List[Dict[str, Any]]]
+Counter = Callable[[int, Optional[float]], int]
+ArchiveCheck = Callable[[int], bool]
+
+
+def _epoch(ts: datetime) -> float:
+    """
+    Convert a naive (UTC, as returned by MongoDB) or aware datetime to epoch seconds.
+    """
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+def _str_bytes(value: Optional[str]) -> int:
+    return sys.getsizeof(value) if value is not None else 0
+
+
+class ChatRing:
+    """
+    Fixed-capacity ring of a chat's most recent messages.
+
+    Numeric fields live in typed arrays and strings in preallocated lists, so a
+    slot costs a few pointers plus its text rather than a whole dict.
+    """
+
+    __slots__ = (
+        "capacity", "message_ids", "user_ids", "timestamps", "texts", "usernames",
+        "full_names", "head", "size", "warmed", "complete", "nbytes",
+    )
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.message_ids = array("q", [0]) * capacity
+        self.user_ids = array("q", [0]) * capacity
+        self.timestamps = array("d", [0.0]) * capacity
+        self.texts: List[Optional[str]] = [None] * capacity
+        self.usernames: List[Optional[str]] = [None] * capacity
+        self.full_names: List[Optional[str]] = [None] * capacity
+        self.head = 0        # Next slot to write.
+        self.size = 0
+        self.warmed = False  # Loaded from MongoDB at least once.
+        self.complete = False  # Holds the chat's entire history.
+        self.nbytes = capacity * _SLOT_BYTES
+
+    def _slot_bytes(self, index: int) -> int:
+        return (_str_bytes(self.texts[index]) + _str_bytes(self.usernames[index])
+                + _str_bytes(self.full_names[index]))
+
+    def append(self, doc: Dict[str, Any]) -> None:
+        """
+        Store a message document, overwriting the oldest one when full.
+        """
+        index = self.head
+        if self.size == self.capacity:
+            self.nbytes -= self._slot_bytes(index)
+            self.complete = False
+        else:
+            self.size += 1
+        self.message_ids[index] = doc["message_id"]
+        self.user_ids[index] = doc["user_id"]
+        self.timestamps[index] = _epoch(doc["timestamp"])
+        self.texts[index] = doc.get("text")
+        self.usernames[index] = doc.get("username")
+        self.full_names[index] = doc.get("full_name")
+        self.nbytes += self._slot_bytes(index)
+        self.head = (index + 1) % self.capacity
+
+    def indices(self) -> range:
+        """
+        Return slot positions from oldest to newest (modulo capacity).
+        """
+        start = self.head - self.size
+        return range(start, self.head)
+
+    def to_doc(self, chat_id: int, index: int) -> Dict[str, Any]:
+        index %= self.capacity
+        return {
+            "message_id": self.message_ids[index],
+            "chat_id": chat_id,
+            "user_id": self.user_ids[index],
+            "username": self.usernames[index],
+            "full_name": self.full_names[index],
+            "text": self.texts[index],
+            # Naive UTC, matching what MongoDB returns.
+            "timestamp": datetime.fromtimestamp(self.timestamps[index], timezone.utc).replace(tzinfo=None),
+        }
+
+    def oldest_timestamp(self) -> Optional[float]:
+        return self.timestamps[(self.head - self.size) % self.capacity] if self.size else None
+
+    def count_after(self, after: Optional[float]) -> int:
+        """
+        Return how many held messages are strictly newer than `after` (all if None).
+        """
+        if after is None:
+            return self.size
+        return sum(1 for i in self.indices() if self.timestamps[i % self.capacity] > after)
+
+
+def _load_recent(chat_id: int, limit: int) -> List[Dict[str, Any]]:
+    """
+    Load a chat's `limit` most recent messages from MongoDB, newest first.
+    """
+    from db_functions import messages_collection
+    return list(messages_collection.find({"chat_id": chat_id}).sort("timestamp", -1).limit(limit))
+
+
+def _count_stored(chat_id: int, after: Optional[float]) -> int:
+    """
+    Count a chat's messages in MongoDB strictly newer than `after` (all if None).
+    """
+    from db_functions import messages_collection
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if after is not None:
+        query["timestamp"] = {"$gt": datetime.fromtimestamp(after, timezone.utc)}
+    return messages_collection.count_documents(query)
+
+
+def _has_archive(chat_id: int) -> bool:
+    """
+    Return True if some of the chat's messages were compacted into archive buckets.
+    """
+    from db_functions import message_buckets_collection
+    return message_buckets_collection.find_one({"chat_id": chat_id}, {"_id": 1}) is not None
+
+
+class RecentMessageCache:
+    """
+    Per-chat rings of recent messages, populated at ingest and warmed lazily
+    from MongoDB the first time a chat is read.
+
+    Chats are kept in LRU order and the least recently used ones are evicted
+    once the estimated memory use exceeds `max_bytes`. Reads that the ring
+    cannot answer exactly (a window older than the ring, too few matches)
+    return None so callers fall back to MongoDB.
+
+    A ring only sees the messages this process ingests, which with several
+    shard workers is not every message of the chat (the front never ingests,
+    and chats move between workers). Before each read the ring is checked
+    against an indexed count of the chat's messages in MongoDB over the span
+    it covers, and reloaded if they differ. A ring counts as the chat's
+    entire history only if none of it has been compacted into archive buckets.
+    """
+
+    def __init__(self, per_chat: int = MESSAGES_PER_CHAT, max_bytes: int = MAX_CACHE_BYTES,
+                 loader: Loader = _load_recent, counter: Counter = _count_stored,
+                 has_archive: ArchiveCheck = _has_archive):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.counter = counter
+        self.has_archive = has_archive
+        self._rings: "OrderedDict[int, ChatRing]" = OrderedDict()
+        self.nbytes = 0
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "fallbacks": 0, "evictions": 0}
+
+    def _touch(self, chat_id: int) -> ChatRing:
+        ring = self._rings.get(chat_id)
+        if ring is None:
+            ring = ChatRing(self.per_chat)
+            self._rings[chat_id] = ring
+            self.nbytes += ring.nbytes
+        else:
+            self._rings.move_to_end(chat_id)
+        return ring
+
+    def _evict(self) -> None:
+        while self.nbytes > self.max_bytes and len(self._rings) > 1:
+            _, ring = self._rings.popitem(last=False)
+            self.nbytes -= ring.nbytes
+            self.counters["evictions"] += 1
+
+    def _append(self, ring: ChatRing, doc: Dict[str, Any]) -> None:
+        before = ring.nbytes
+        ring.append(doc)
+        self.nbytes += ring.nbytes - before
+
+    def ingest(self, doc: Dict[str, Any]) -> None:
+        """
+        Add a freshly stored message to its chat's ring.
+
+        Args:
+            doc (Dict[str, Any]): A message document as passed to `insert_message`.
+        """
+        self._append(self._touch(doc["chat_id"]), doc)
+        self._evict()
+
+    def _is_current(self, chat_id: int, ring: ChatRing) -> bool:
+        """
+        Check that MongoDB holds exactly the ring's messages over the span the
+        ring covers: all of the chat's messages if it is complete, otherwise
+        those newer than its oldest one (older ones may share that timestamp).
+        """
+        after = None if ring.complete else ring.oldest_timestamp()
+        return self.counter(chat_id, after) == ring.count_after(after)
+
+    def _ring_for_read(self, chat_id: int) -> ChatRing:
+        """
+        Return the chat's ring, (re)loading it from MongoDB on first access or
+        when it no longer matches the stored messages. Ingested messages missing
+        from the load (e.g. still spooled) are merged in after the loaded ones.
+        """
+        ring = self._touch(chat_id)
+        if ring.warmed:
+            if self._is_current(chat_id, ring):
+                self.counters["hits"] += 1
+                return ring
+            self.counters["stale"] += 1
+        else:
+            self.counters["misses"] += 1
+
+        pending = [ring.to_doc(chat_id, i) for i in ring.indices()]
+        loaded = self.loader(chat_id, self.per_chat)
+        seen = {doc["message_id"] for doc in loaded}
+        newest = _epoch(loaded[0]["timestamp"]) if loaded else None
+        fresh = ChatRing(self.per_chat)
+        for doc in reversed(loaded):
+            fresh.append(doc)
+        for doc in pending:
+            # Older leftovers were compacted or deleted in MongoDB; drop them.
+            if doc["message_id"] not in seen and (newest is None or _epoch(doc["timestamp"]) >= newest):
+                fresh.append(doc)
+        fresh.warmed = True
+        fresh.complete = (len(loaded) < self.per_chat and fresh.size < self.per_chat
+                          and not self.has_archive(chat_id))
+        self.nbytes += fresh.nbytes - ring.nbytes
+        self._rings[chat_id] = fresh
+        self._evict()
+        return fresh
+
+    def recent(self, chat_id: int, limit: int) -> List[Dict[str, Any]]:
+        """
+        Return up to `limit` of the chat's latest messages in chronological order.
+        Serves any limit up to the per-chat capacity.
+        """
+        if limit > self.per_chat:
+            self.counters["fallbacks"] += 1
+            return list(reversed(self.loader(chat_id, limit)))
+        ring = self._ring_for_read(chat_id)
+        indices = ring.indices()
+        return [ring.to_doc(chat_id, i) for i in indices[max(0, len(indices) - limit):]]
+
+    def window(self, chat_id: int, start: datetime, end: datetime) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return the chat's messages with start <= timestamp < end in chronological
+        order, or None if the ring may not hold the whole window.
+        """
+        ring = self._ring_for_read(chat_id)
+        lo, hi = _epoch(start), _epoch(end)
+        oldest = ring.oldest_timestamp()
+        # Evicted messages are no newer than the oldest kept one, so the window
+        # is fully covered only if it starts strictly after that message.
+        if not ring.complete and (oldest is None or oldest >= lo):
+            self.counters["fallbacks"] += 1
+            return None
+        return [ring.to_doc(chat_id, i) for i in ring.indices()
+                if lo <= ring.timestamps[i % ring.capacity] < hi]
+
+    def search(self, chat_id: int, predicate: Callable[[Dict[str, Any]], bool],
+               limit: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return the newest `limit` messages matching `predicate`, newest first, or
+        None if the ring holds fewer matches and may be missing older ones.
+        """
+        ring = self._ring_for_read(chat_id)
+        matches = []
+        for i in reversed(ring.indices()):
+            doc = ring.to_doc(chat_id, i)
+            if predicate(doc):
+                matches.append(doc)
+                if len(matches) == limit:
+                    return matches
+        if ring.complete:
+            return matches
+        self.counters["fallbacks"] += 1
+        return None
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Return hit-rate and memory metrics.
+        """
+        reads = self.counters["hits"] + self.counters["misses"] + self.counters["stale"]
+        return {
+            **self.counters,
+            "hit_rate": round(self.counters["hits"] / reads, 3) if reads else None,
+            "chats": len(self._rings),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    async def log_metrics(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Job-queue callback that logs the cache metrics.
+        """
+        logger.info(f"Message cache: {self.metrics()}")
+
+
+# Shared cache for this process.
+message_cache = RecentMessageCache()
@@ -0,0 +1,269 @@
+"""
+Retention tiers for the `messages` collection.
+
+Raw messages stay in `messages` for HOT_WINDOW_DAYS. Older ones are rolled
+into one compressed `message_buckets` document per chat and UTC day, and the
+username/full name repeated on every row is kept once in `user_profiles`.
+
+    python src/retention.py report [--hot-days N]
+    python src/retention.py compact [--hot-days N] [--pause SECONDS] [--max-days N]
+
+`report` is a dry run that builds every bucket in memory and prints the
+projected storage savings. `compact` is an online migration: each chat-day is
+written to its bucket before its raw messages are deleted, one chat-day at a
+time with a pause in between, so it can run next to the bot and be stopped
+and resumed at any point.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bson
+from dotenv import load_dotenv
+from pymongo import ASCENDING
+from telegram.ext import ContextTypes
+
+load_dotenv()
+
+from db_functions import (
+    messages_collection,
+    message_buckets_collection,
+    user_profiles_collection,
+    encode_bucket_rows,
+    decode_bucket_rows,
+)
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+HOT_WINDOW_DAYS = int(os.getenv("HOT_WINDOW_DAYS", "90"))
+# Seconds to sleep between chat-days during an online migration.
+COMPACTION_PAUSE_SECONDS = float(os.getenv("COMPACTION_PAUSE_SECONDS", "0.2"))
+# Enables the periodic in-bot compaction job; the CLI works regardless.
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "0") == "1"
+# Chat-days compacted per periodic run.
+COMPACTION_DAYS_PER_RUN = int(os.getenv("COMPACTION_DAYS_PER_RUN", "500"))
+# Buckets larger than this are left raw; MongoDB documents are capped at 16 MB.
+MAX_BUCKET_BYTES = 12 * 1024 * 1024
+
+
+def ensure_indexes() -> None:
+    """
+    Create the indexes used by bucket readers and the migration.
+    """
+    message_buckets_collection.create_index([("chat_id", ASCENDING), ("day", ASCENDING)], unique=True)
+    message_buckets_collection.create_index([("chat_id", ASCENDING), ("user_counts.user_id", ASCENDING)])
+    messages_collection.create_index([("timestamp", ASCENDING)])
+
+
+def cold_days(cutoff: datetime) -> Iterator[Tuple[int, datetime]]:
+    """
+    Yield every (chat_id, UTC day) that still has raw messages older than `cutoff`,
+    oldest day first.
+    """
+    cursor = messages_collection.aggregate([
+        {"$match": {"timestamp": {"$lt": cutoff}}},
+        {"$group": {"_id": {
+            "chat_id": "$chat_id",
+            "day": {"$dateTrunc": {"date": "$timestamp", "unit": "day"}},
+        }}},
+        {"$sort": {"_id.day": 1, "_id.chat_id": 1}},
+    ], allowDiskUse=True)
+    for doc in cursor:
+        yield doc["_id"]["chat_id"], doc["_id"]["day"]
+
+
+def _as_utc(ts: datetime) -> datetime:
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+def build_bucket(chat_id: int, day: datetime, raw: List[Dict[str, Any]],
+                 existing: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Build the bucket document for a chat-day from raw messages, merged with the
+    rows of an existing bucket for the same day (re-runs and late arrivals).
+
+    Args:
+        chat_id (int): The chat identifier.
+        day (datetime): The UTC day the bucket covers.
+        raw (List[Dict[str, Any]]): Raw message documents of that day.
+        existing (Dict[str, Any]): The bucket already stored for that day, if any.
+
+    Returns:
+        Dict[str, Any]: The bucket document (without `_id`).
+    """
+    rows = {row[0]: row for row in decode_bucket_rows(existing)} if existing else {}
+    for doc in raw:
+        rows[doc["message_id"]] = [
+            doc["message_id"], doc["user_id"], _as_utc(doc["timestamp"]).timestamp(), doc.get("text") or "",
+        ]
+    ordered = sorted(rows.values(), key=lambda row: (row[2], row[0]))
+    user_counts: Dict[int, int] = {}
+    for row in ordered:
+        user_counts[row[1]] = user_counts.get(row[1], 0) + 1
+    return {
+        "chat_id": chat_id,
+        "day": day,
+        "count": len(ordered),
+        "first_at": datetime.fromtimestamp(ordered[0][2], timezone.utc),
+        "last_at": datetime.fromtimestamp(ordered[-1][2], timezone.utc),
+        "user_counts": [{"user_id": user_id, "count": count} for user_id, count in user_counts.items()],
+        "data": encode_bucket_rows(ordered),
+    }
+
+
+def _latest_names(raw: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    """
+    Return the most recent username and full name seen for each user, with the
+    time they were seen (`names_at`).
+    """
+    names: Dict[int, Dict[str, Any]] = {}
+    for doc in sorted(raw, key=lambda doc: doc["timestamp"]):
+        names[doc["user_id"]] = {
+            "username": doc.get("username"),
+            "full_name": doc.get("full_name"),
+            "names_at": doc["timestamp"],
+        }
+    return names
+
+
+def _update_profile_names(chat_id: int, user_id: int, names: Dict[str, Any]) -> None:
+    """
+    Store a user's names in user_profiles unless newer ones are already there,
+    since days are compacted oldest first but may be re-run out of order.
+    """
+    user_profiles_collection.update_one(
+        {"chat_id": chat_id, "user_id": user_id, "$or": [
+            {"names_at": {"$exists": False}}, {"names_at": {"$lt": names["names_at"]}},
+        ]},
+        {"$set": names},
+    )
+    user_profiles_collection.update_one(
+        {"chat_id": chat_id, "user_id": user_id}, {"$setOnInsert": names}, upsert=True
+    )
+
+
+def compact_day(chat_id: int, day: datetime, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Roll one chat-day of raw messages into its bucket.
+
+    The bucket and user profiles are written before any raw message is deleted,
+    and deletion is limited to the messages that were read, so an interrupted
+    run loses nothing and simply redoes the day.
+
+    Args:
+        chat_id (int): The chat identifier.
+        day (datetime): The UTC day to compact.
+        dry_run (bool): Only measure, don't write or delete anything.
+
+    Returns:
+        Dict[str, int]: Messages and bytes before and after compaction.
+    """
+    day = _as_utc(day)
+    raw = list(messages_collection.find({
+        "chat_id": chat_id,
+        "timestamp": {"$gte": day, "$lt": day + timedelta(days=1)},
+    }))
+    if not raw:
+        return {"messages": 0, "raw_bytes": 0, "bucket_bytes": 0}
+    existing = message_buckets_collection.find_one({"chat_id": chat_id, "day": day})
+    bucket = build_bucket(chat_id, day, raw, existing)
+    bucket_bytes = len(bson.encode(bucket))
+    existing_bytes = len(bson.encode(existing)) if existing else 0
+    stats = {
+        "messages": len(raw),
+        "raw_bytes": sum(len(bson.encode(doc)) for doc in raw),
+        "bucket_bytes": bucket_bytes - existing_bytes,
+    }
+    if bucket_bytes > MAX_BUCKET_BYTES:
+        logger.warning(f"Bucket for chat {chat_id} on {day:%Y-%m-%d} would be {bucket_bytes} bytes, keeping it raw.")
+        return {"messages": 0, "raw_bytes": 0, "bucket_bytes": 0}
+    if dry_run:
+        return stats
+
+    message_buckets_collection.update_one(
+        {"chat_id": chat_id, "day": day}, {"$set": bucket}, upsert=True
+    )
+    for user_id, names in _latest_names(raw).items():
+        _update_profile_names(chat_id, user_id, names)
+    messages_collection.delete_many({"_id": {"$in": [doc["_id"] for doc in raw]}})
+    return stats
+
+
+def run_compaction(hot_days: int = HOT_WINDOW_DAYS, dry_run: bool = False,
+                   pause: float = COMPACTION_PAUSE_SECONDS, max_days: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Compact every chat-day older than the hot window, or report what it would save.
+
+    Args:
+        hot_days (int): Days of raw messages to keep.
+        dry_run (bool): Build buckets in memory only and report projected savings.
+        pause (float): Seconds to sleep between chat-days (throttling).
+        max_days (int): Stop after this many chat-days; None for all.
+
+    Returns:
+        Dict[str, Any]: Totals of processed chat-days, messages and bytes.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=hot_days)
+    # Never compact the current partial UTC day of the cutoff.
+    cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+    totals = {"chat_days": 0, "messages": 0, "raw_bytes": 0, "bucket_bytes": 0}
+    for chat_id, day in cold_days(cutoff):
+        stats = compact_day(chat_id, day, dry_run=dry_run)
+        totals["chat_days"] += 1
+        for key, value in stats.items():
+            totals[key] += value
+        if totals["chat_days"] % 100 == 0:
+            logger.info(f"Compaction progress: {totals}")
+        if max_days is not None and totals["chat_days"] >= max_days:
+            break
+        if pause and not dry_run:
+            time.sleep(pause)
+
+    saved = totals["raw_bytes"] - totals["bucket_bytes"]
+    totals.update(
+        dry_run=dry_run,
+        cutoff=cutoff.isoformat(),
+        saved_bytes=saved,
+        saved_percent=round(100 * saved / totals["raw_bytes"], 1) if totals["raw_bytes"] else 0.0,
+    )
+    return totals
+
+
+async def compaction_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job-queue callback running one bounded, throttled compaction pass in a thread.
+    """
+    totals = await asyncio.to_thread(run_compaction, max_days=COMPACTION_DAYS_PER_RUN)
+    if totals["chat_days"]:
+        logger.info(f"Compaction pass: {totals}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compact messages older than the hot window.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("report", "Dry run: print projected storage savings."),
+                            ("compact", "Run the online migration.")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--hot-days", type=int, default=HOT_WINDOW_DAYS)
+        command.add_argument("--max-days", type=int, help="Stop after this many chat-days.")
+    commands.choices["compact"].add_argument("--pause", type=float, default=COMPACTION_PAUSE_SECONDS)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "report":
+        totals = run_compaction(args.hot_days, dry_run=True, max_days=args.max_days)
+    else:
+        ensure_indexes()
+        totals = run_compaction(args.hot_days, pause=args.pause, max_days=args.max_days)
+    print(json.dumps(totals, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
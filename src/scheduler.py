@@ -0,0 +1,206 @@
+import os
+import uuid
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from telegram.ext import ContextTypes
+
+from db_functions import scheduled_jobs_collection
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+# Job states stored in the `status` field.
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+JobHandler = Callable[[Any, Dict[str, Any]], Awaitable[None]]
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class PersistentScheduler:
+    """
+    A restart-safe one-off job scheduler backed by a MongoDB collection.
+
+    Jobs are plain documents indexed by due time, so nothing is held in memory
+    between sweeps. Each sweep runs up to `batch_size` due jobs, taking a
+    time-limited lease on each one just before its handler runs, so a lease
+    only has to outlive a single job; a replica that crashes mid-job simply
+    lets its lease expire and another sweeper picks the job up. Jobs that
+    became due while the bot was down are run on the next sweep.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        owner: Optional[str] = None,
+        lease_seconds: int = 300,
+        batch_size: int = 50,
+        max_attempts: int = 5,
+        retry_delay: timedelta = timedelta(minutes=5),
+        clock: Callable[[], datetime] = _utcnow,
+    ):
+        """
+        Args:
+            collection (Collection): The collection storing job documents.
+            owner (str): Identifier of this sweeper; defaults to a random id.
+            lease_seconds (int): How long a claimed job stays reserved.
+            batch_size (int): Maximum number of jobs run per sweep.
+            max_attempts (int): Attempts before a job is marked as failed.
+            retry_delay (timedelta): Delay before a failed job is retried.
+            clock (Callable[[], datetime]): Returns the current UTC time; injectable for tests.
+        """
+        self.collection = collection
+        self.owner = owner or uuid.uuid4().hex
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.clock = clock
+        self.handlers: Dict[str, JobHandler] = {}
+
+    def ensure_indexes(self) -> None:
+        """
+        Create the indexes used for claiming due jobs and deduplicating keys.
+        """
+        self.collection.create_index([("status", ASCENDING), ("due_at", ASCENDING)])
+        self.collection.create_index([("lease_expires_at", ASCENDING)])
+        self.collection.create_index("key", unique=True, sparse=True)
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        """
+        Register the coroutine that runs jobs of the given kind.
+
+        Args:
+            kind (str): The job kind stored on the job document.
+            handler (JobHandler): Coroutine called as `handler(bot, job)`.
+        """
+        self.handlers[kind] = handler
+
+    def schedule(self, kind: str, due_at: datetime, chat_id: Optional[int] = None,
+                 data: Optional[Dict[str, Any]] = None, key: Optional[str] = None) -> bool:
+        """
+        Persist a job to run at or after `due_at`.
+
+        Args:
+            kind (str): The registered job kind.
+            due_at (datetime): When the job becomes due (UTC).
+            chat_id (int): Optional chat the job belongs to.
+            data (Dict[str, Any]): Optional payload passed to the handler.
+            key (str): Optional unique key; scheduling an existing key is a no-op.
+
+        Returns:
+            bool: True if a new job was stored, False if the key already existed.
+        """
+        job = {
+            "kind": kind,
+            "chat_id": chat_id,
+            "data": data or {},
+            "due_at": due_at,
+            "status": PENDING,
+            "attempts": 0,
+            "created_at": self.clock(),
+        }
+        if key is not None:
+            job["key"] = key
+        try:
+            self.collection.insert_one(job)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """
+        Atomically lease the oldest due job that is pending or whose lease expired.
+        """
+        now = self.clock()
+        return self.collection.find_one_and_update(
+            {
+                "due_at": {"$lte": now},
+                "$or": [
+                    {"status": PENDING},
+                    {"status": LEASED, "lease_expires_at": {"$lte": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": LEASED,
+                    "lease_owner": self.owner,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("due_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _finish(self, job: Dict[str, Any], update: Dict[str, Any]) -> None:
+        """
+        Update a job only while this sweeper still holds its lease.
+        """
+        self.collection.update_one(
+            {"_id": job["_id"], "status": LEASED, "lease_owner": self.owner},
+            {"$set": update, "$unset": {"lease_owner": "", "lease_expires_at": ""}},
+        )
+
+    async def run_due(self, bot: Any) -> int:
+        """
+        Run due jobs one at a time, up to `batch_size` per call.
+
+        Each job is claimed right before its handler runs rather than leasing the
+        whole batch up front, where jobs at the end of a slow batch could outlive
+        their lease and be claimed and sent a second time by another replica.
+
+        Args:
+            bot (Any): The Telegram bot passed to job handlers.
+
+        Returns:
+            int: The number of jobs that completed successfully.
+        """
+        completed = 0
+        for _ in range(self.batch_size):
+            job = self._claim()
+            if job is None:
+                break
+            handler = self.handlers.get(job["kind"])
+            if handler is None:
+                logger.error(f"No handler registered for job kind '{job['kind']}'")
+                self._finish(job, {"status": FAILED, "error": "unknown kind"})
+                continue
+            try:
+                await handler(bot, job)
+            except Exception as e:
+                logger.error(f"Scheduled job {job['_id']} ({job['kind']}) failed: {e}")
+                if job["attempts"] >= self.max_attempts:
+                    self._finish(job, {"status": FAILED, "error": str(e)})
+                else:
+                    self._finish(job, {"status": PENDING, "error": str(e),
+                                       "due_at": self.clock() + self.retry_delay})
+                continue
+            self._finish(job, {"status": DONE, "finished_at": self.clock()})
+            completed += 1
+        return completed
+
+    async def sweep(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Job-queue callback that runs due jobs; register with `run_repeating`.
+        """
+        completed = await self.run_due(context.bot)
+        if completed:
+            logger.info(f"Scheduler {self.owner} completed {completed} job(s).")
+
+
+# Seconds between sweeps of the job collection.
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SCHEDULER_SWEEP_SECONDS", "60"))
+
+# Shared scheduler instance used by the bot handlers.
+scheduler = PersistentScheduler(scheduled_jobs_collection)
@@ -0,0 +1,315 @@
+import os
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+from queue import Empty
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes, TypeHandler
+
+from admission import ai_admission
+from db_functions import worker_leases_collection
+
+# Set up and export the logger.
+logger = logging.getLogger(__name__)
+
+# Seconds a worker lease stays valid without being renewed.
+LEASE_SECONDS = int(os.getenv("SHARD_LEASE_SECONDS", "15"))
+# Seconds between lease renewals and between front-side supervision passes.
+HEARTBEAT_SECONDS = max(1, LEASE_SECONDS // 3)
+# Separates the leases of independent deployments sharing a database.
+SHARD_GROUP = os.getenv("SHARD_GROUP", "default")
+
+
+class HashRing:
+    """
+    A consistent hash ring mapping chat ids to worker ids.
+
+    Each worker is placed on the ring `replicas` times, so removing or adding a
+    worker only moves the chats that hashed to its points.
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 64):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for node in nodes:
+            for replica in range(replicas):
+                point = self._hash(f"{node}#{replica}")
+                self._owners[point] = node
+                bisect.insort(self._points, point)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def __bool__(self) -> bool:
+        return bool(self._points)
+
+    def node_for(self, key: Any) -> Optional[str]:
+        """
+        Return the worker owning `key`, or None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+# --- Worker leases ---
+
+def _lease_id(worker_id: str) -> str:
+    return f"{SHARD_GROUP}:{worker_id}"
+
+
+def renew_lease(worker_id: str) -> None:
+    """
+    Create or extend the liveness lease of a worker.
+    """
+    now = datetime.now(timezone.utc)
+    worker_leases_collection.update_one(
+        {"_id": _lease_id(worker_id)},
+        {"$set": {
+            "group": SHARD_GROUP,
+            "worker_id": worker_id,
+            "pid": os.getpid(),
+            "renewed_at": now,
+            "expires_at": now + timedelta(seconds=LEASE_SECONDS),
+        }},
+        upsert=True,
+    )
+
+
+def release_lease(worker_id: str) -> None:
+    """
+    Drop a worker's lease so its chats are rebalanced immediately.
+    """
+    worker_leases_collection.delete_one({"_id": _lease_id(worker_id)})
+
+
+def live_workers() -> List[str]:
+    """
+    Return the ids of workers holding an unexpired lease, sorted.
+    """
+    now = datetime.now(timezone.utc)
+    cursor = worker_leases_collection.find(
+        {"group": SHARD_GROUP, "expires_at": {"$gt": now}}, {"worker_id": 1}
+    )
+    return sorted(doc["worker_id"] for doc in cursor)
+
+
+# --- Worker process ---
+
+async def _heartbeat(worker_id: str) -> None:
+    while True:
+        try:
+            await asyncio.to_thread(renew_lease, worker_id)
+        except Exception as e:
+            logger.error(f"Worker {worker_id} failed to renew its lease: {e}")
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+
+
+async def _run_worker(worker_id: str, queue: multiprocessing.Queue, token: str,
+                      build_application: Callable[[str], Any]) -> None:
+    application = build_application(token)
+    async with application:
+        await application.start()
+        heartbeat = asyncio.create_task(_heartbeat(worker_id))
+        logger.info(f"Shard worker {worker_id} started (pid {os.getpid()}).")
+        try:
+            while True:
+                data = await asyncio.to_thread(queue.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            heartbeat.cancel()
+            release_lease(worker_id)
+            await application.stop()
+
+
+def ai_share(num_workers: int, total: Optional[int] = None) -> int:
+    """
+    Return each process's share of the deployment-wide OpenAI concurrency
+    limit (AI_MAX_IN_FLIGHT), split between the workers and the front.
+
+    Every process has its own admission controller, so without the split the
+    deployment would run up to (num_workers + 1) times the configured limit.
+    Each process keeps at least one slot, so the total can exceed a limit
+    smaller than the number of processes.
+    """
+    total = ai_admission.max_in_flight if total is None else total
+    return max(1, total // (num_workers + 1))
+
+
+def _worker_main(worker_id: str, queue: multiprocessing.Queue, token: str,
+                 build_application: Callable[[str], Any], max_in_flight: int) -> None:
+    """
+    Entry point of a worker process: handles the updates routed to it.
+    """
+    logging.basicConfig(level=logging.INFO)
+    ai_admission.set_max_in_flight(max_in_flight)
+    try:
+        asyncio.run(_run_worker(worker_id, queue, token, build_application))
+    except KeyboardInterrupt:
+        pass
+
+
+# --- Front process ---
+
+def routing_key(update: Update) -> int:
+    """
+    Return the key an update is sharded on: its chat, falling back to its user
+    (e.g. inline queries) and finally to the update id.
+    """
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+class ShardFront:
+    """
+    Receives updates in the front process and forwards each one to the worker
+    that owns its chat, so chat-affine state stays warm in a single process.
+
+    The ring only contains workers with a live lease in MongoDB. When a worker
+    dies its lease expires, its chats move to the remaining workers, and the
+    supervisor restarts it; once it renews its lease it gets its chats back.
+    Updates arriving while no worker is live are handled by the front itself.
+    """
+
+    def __init__(self, token: str, num_workers: int, build_application: Callable[[str], Any]):
+        self.token = token
+        self.build_application = build_application
+        self.context = multiprocessing.get_context("spawn")
+        self.worker_ids = [f"worker-{index}" for index in range(num_workers)]
+        self.max_in_flight = ai_share(num_workers)
+        # Each spawn gets a fresh queue: a worker killed while blocked in
+        # `queue.get` dies holding the queue's read lock, and a successor on the
+        # same queue would never receive anything again.
+        self.queues: Dict[str, Any] = {}
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self.ring = HashRing([])
+        self._ring_members: List[str] = []
+
+    def _spawn(self, worker_id: str) -> None:
+        self.queues[worker_id] = self.context.Queue()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(worker_id, self.queues[worker_id], self.token, self.build_application, self.max_in_flight),
+            name=worker_id,
+            daemon=True,
+        )
+        process.start()
+        self.processes[worker_id] = process
+
+    def start_workers(self) -> None:
+        for worker_id in self.worker_ids:
+            self._spawn(worker_id)
+
+    def refresh_ring(self) -> None:
+        """
+        Rebuild the hash ring from the currently live leases.
+        """
+        members = [w for w in live_workers() if w in self.processes and self.processes[w].is_alive()]
+        if members != self._ring_members:
+            logger.info(f"Shard ring changed: {self._ring_members} -> {members}")
+            self.ring = HashRing(members)
+            self._ring_members = members
+
+    @staticmethod
+    def _salvage(queue: Any, wait: float = 0.2) -> List[Dict[str, Any]]:
+        """
+        Take the updates a dead worker left in its queue, then close the queue.
+
+        A timed `get` never blocks on the read lock: if the worker died holding
+        it, the remaining updates cannot be read back safely and are given up.
+        """
+        salvaged = []
+        while True:
+            try:
+                data = queue.get(timeout=wait)
+            except Empty:
+                break
+            except Exception as e:
+                logger.error(f"Could not salvage updates from a dead worker's queue: {e}")
+                break
+            if data is not None:
+                salvaged.append(data)
+        queue.close()
+        queue.cancel_join_thread()
+        return salvaged
+
+    async def supervise(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Job-queue callback: restart dead workers and rebalance the ring.
+
+        Updates still queued for a dead worker are fed back through the front's
+        update queue, so `route` sends them to the chat's current owner.
+        """
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            logger.warning(f"Shard worker {worker_id} exited with {process.exitcode}, restarting.")
+            release_lease(worker_id)
+            old_queue = self.queues[worker_id]
+            # Routing switches to the new queue before the old one is emptied.
+            self._spawn(worker_id)
+            salvaged = await asyncio.to_thread(self._salvage, old_queue)
+            if salvaged:
+                logger.info(f"Re-routing {len(salvaged)} update(s) left by {worker_id}.")
+            for data in salvaged:
+                await context.application.update_queue.put(Update.de_json(data, context.bot))
+        await asyncio.to_thread(self.refresh_ring)
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Forward an update to its worker and stop local handling of it.
+        """
+        worker_id = self.ring.node_for(routing_key(update))
+        if worker_id is None:
+            return
+        self.queues[worker_id].put(update.to_dict())
+        raise ApplicationHandlerStop
+
+    def stop_workers(self) -> None:
+        for queue in self.queues.values():
+            queue.put(None)
+        for process in self.processes.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+
+def run_sharded(token: str, num_workers: int, build_application: Callable[[str], Any],
+                register_background_jobs: Callable[[Any], None]) -> None:
+    """
+    Run the bot as a polling front process plus `num_workers` worker processes.
+
+    Args:
+        token (str): The Telegram bot token.
+        num_workers (int): Number of worker processes.
+        build_application (Callable): Builds an application with all handlers registered.
+        register_background_jobs (Callable): Schedules the periodic jobs on the front.
+    """
+    front = ShardFront(token, num_workers, build_application)
+    front.start_workers()
+    # The front runs the scheduled jobs and handles updates while no worker is live.
+    ai_admission.set_max_in_flight(front.max_in_flight)
+
+    application = build_application(token)
+    # Group -1 runs before the regular handlers, which only see updates the
+    # front keeps for itself.
+    application.add_handler(TypeHandler(Update, front.route), group=-1)
+    register_background_jobs(application)
+    application.job_queue.run_repeating(front.supervise, interval=HEARTBEAT_SECONDS, first=HEARTBEAT_SECONDS)
+    try:
+        application.run_polling(timeout=10)
+    finally:
+        front.stop_workers()
@@ -1,15 +1,24 @@
 import io
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 import matplotlib.pyplot as plt
 from telegram import Update
 from telegram.ext import ContextTypes
 from db_functions import messages_collection
+from activity_analytics import WEEKDAYS, hour_of_week_heatmap, daily_trend
 
 async def send_activity_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Generate and send a pie chart showing the percentage of messages sent by each user.
+    `/activity heatmap` and `/activity trend` send the time-series charts instead.
     """
     chat_id = update.effective_chat.id
+    if context.args and context.args[0] == "heatmap":
+        await send_heatmap_chart(update, context)
+        return
+    if context.args and context.args[0] == "trend":
+        await send_trend_chart(update, context)
+        return
 
     # Aggregate message counts by username.
     pipeline = [
@@ -45,3 +54,53 @@ async def send_activity_chart(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Send the chart as a photo to the chat.
     await context.bot.send_photo(chat_id, photo=buffer)
     buffer.close()
+
+async def _send_figure(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Render the current matplotlib figure to PNG and send it to the chat.
+    """
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format="png", bbox_inches="tight")
+    buffer.seek(0)
+    plt.close()
+    await context.bot.send_photo(chat_id, photo=buffer)
+    buffer.close()
+
+async def send_heatmap_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Send an hour-of-week heatmap of the chat's messages over the last 90 days.
+    """
+    from digests import chat_timezone
+    chat_id = update.effective_chat.id
+    now = datetime.now(timezone.utc)
+    heatmap = hour_of_week_heatmap(chat_id, now - timedelta(days=90), now, chat_timezone(chat_id))
+    if not heatmap.any():
+        await context.bot.send_message(chat_id, "No activity data available.")
+        return
+
+    plt.figure(figsize=(10, 4))
+    plt.imshow(heatmap, aspect="auto", cmap="YlOrRd")
+    plt.colorbar(label="Messages")
+    plt.yticks(range(7), WEEKDAYS)
+    plt.xticks(range(0, 24, 2))
+    plt.xlabel("Hour of day")
+    plt.title("When is this chat active? (last 90 days)")
+    await _send_figure(chat_id, context)
+
+async def send_trend_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Send a bar chart of the chat's daily message counts over the last 30 days.
+    """
+    from digests import chat_timezone
+    chat_id = update.effective_chat.id
+    days, counts = daily_trend(chat_id, 30, chat_timezone(chat_id))
+    if not counts.any():
+        await context.bot.send_message(chat_id, "No activity data available.")
+        return
+
+    plt.figure(figsize=(10, 4))
+    plt.bar([day.strftime("%d.%m") for day in days], counts, color=plt.cm.Paired.colors[1])
+    plt.xticks(rotation=60)
+    plt.ylabel("Messages")
+    plt.title("Messages per day (last 30 days)")
+    await _send_figure(chat_id, context)
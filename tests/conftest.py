@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The bot modules live in src/ and import each other by module name.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# db_functions refuses to import without a URI; the client connects lazily and
+# the tests swap every collection they touch for an in-memory fake.
+os.environ.setdefault("URI", "mongodb://localhost:27017")
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,356 @@
+"""
+In-memory stand-ins for the parts of pymongo the bot uses, so the tests run
+without a MongoDB server. Only the query and update operators the bot's code
+actually sends are implemented.
+"""
+import copy
+import functools
+import re
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+def _naive(value: Any) -> Any:
+    # MongoDB stores datetimes as naive UTC.
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _get(doc: Dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        if isinstance(value, list) and part.isdigit():
+            index = int(part)
+            value = value[index] if index < len(value) else None
+        elif isinstance(value, list):
+            # Array of sub-documents: "user_counts.user_id".
+            return [item.get(part) for item in value if isinstance(item, dict)]
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def _has(doc: Dict[str, Any], path: str) -> bool:
+    value: Any = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return False
+        value = value[part]
+    return True
+
+
+def _compare(value: Any, op: str, arg: Any) -> bool:
+    arg = _naive(arg)
+    values = value if isinstance(value, list) else [value]
+    if op == "$eq":
+        return value == arg or arg in values
+    if op == "$ne":
+        return not _compare(value, "$eq", arg)
+    if op == "$in":
+        return any(item in arg for item in values)
+    if op == "$exists":
+        raise AssertionError("$exists is handled by _matches")
+    checks = {"$lt": lambda a, b: a < b, "$lte": lambda a, b: a <= b,
+              "$gt": lambda a, b: a > b, "$gte": lambda a, b: a >= b}
+    return any(item is not None and checks[op](item, arg) for item in values)
+
+
+def matches(doc: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value = _get(doc, key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, arg in condition.items():
+                if op == "$exists":
+                    if _has(doc, key) != bool(arg):
+                        return False
+                elif op == "$regex":
+                    flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+                    if not isinstance(value, str) or not re.search(arg, value, flags):
+                        return False
+                elif op == "$options":
+                    continue
+                elif not _compare(value, op, arg):
+                    return False
+        elif not _compare(value, "$eq", condition):
+            return False
+    return True
+
+
+def _set_path(doc: Dict[str, Any], path: str, value: Any) -> None:
+    parts = path.split(".")
+    target: Any = doc
+    for part in parts[:-1]:
+        target = target[int(part)] if isinstance(target, list) else target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _apply_update(doc: Dict[str, Any], update: Dict[str, Any], inserting: bool) -> None:
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                _set_path(doc, path, copy.deepcopy(_naive(value)))
+            elif op == "$inc":
+                _set_path(doc, path, (_get(doc, path) or 0) + value)
+            elif op == "$unset":
+                parts = path.split(".")
+                parent = _get(doc, ".".join(parts[:-1])) if len(parts) > 1 else doc
+                if isinstance(parent, dict):
+                    parent.pop(parts[-1], None)
+            elif op != "$setOnInsert":
+                raise NotImplementedError(op)
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    for key, spec in projection.items():
+        if isinstance(spec, dict) and "$slice" in spec:
+            skip, limit = spec["$slice"]
+            doc[key] = (doc.get(key) or [])[skip:skip + limit]
+    included = [key for key, spec in projection.items() if spec == 1]
+    if included:
+        keep = set(included) | ({"_id"} if projection.get("_id", 1) else set())
+        keep |= {key for key, spec in projection.items() if isinstance(spec, dict)}
+        doc = {key: value for key, value in doc.items() if key in keep}
+    if projection.get("_id") == 0:
+        doc.pop("_id", None)
+    return doc
+
+
+class UpdateResult:
+    def __init__(self, matched_count: int, upserted_id: Any = None):
+        self.matched_count = matched_count
+        self.modified_count = matched_count
+        self.upserted_id = upserted_id
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids: List[Any]):
+        self.inserted_ids = inserted_ids
+
+
+class DeleteResult:
+    def __init__(self, deleted_count: int):
+        self.deleted_count = deleted_count
+
+
+class FakeCursor:
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self._docs = docs
+
+    def sort(self, key, direction=None):
+        keys = key if isinstance(key, list) else [(key, direction or 1)]
+        for field, order in reversed(keys):
+            self._docs.sort(key=lambda doc: (_get(doc, field) is not None, _get(doc, field)),
+                            reverse=order < 0)
+        return self
+
+    def limit(self, count: int):
+        if count:
+            self._docs = self._docs[:count]
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+def _locked(method):
+    # Hooks and benchmarks call the fakes from several threads at once.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class FakeCollection:
+    """
+    A single in-memory MongoDB collection; each operation is atomic.
+    """
+
+    def __init__(self, name: str = "fake"):
+        self.name = name
+        self.docs: List[Dict[str, Any]] = []
+        self.unique_keys: List[List[str]] = []
+        # Set to an exception instance to make every write raise it.
+        self.fail_with: Optional[Exception] = None
+        self._lock = threading.RLock()
+
+    # Indexes -----------------------------------------------------------
+    @_locked
+    def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        fields = [keys] if isinstance(keys, str) else [field for field, _ in keys]
+        if unique:
+            self.unique_keys.append(fields)
+        return "_".join(fields)
+
+    def _check_unique(self, doc: Dict[str, Any], ignore: Optional[Dict[str, Any]] = None) -> None:
+        for other in self.docs:
+            if other is ignore:
+                continue
+            if other["_id"] == doc["_id"]:
+                raise DuplicateKeyError("duplicate _id", 11000)
+            for fields in self.unique_keys:
+                if any(field not in doc for field in fields):
+                    continue
+                if all(_get(other, field) == _get(doc, field) for field in fields):
+                    raise DuplicateKeyError(f"duplicate key {fields}", 11000)
+
+    def _raise_if_failing(self) -> None:
+        if self.fail_with is not None:
+            raise self.fail_with
+
+    # Writes ------------------------------------------------------------
+    @_locked
+    def insert_one(self, doc: Dict[str, Any]):
+        self._raise_if_failing()
+        doc.setdefault("_id", ObjectId())
+        stored = {key: _naive(value) for key, value in copy.deepcopy(doc).items()}
+        self._check_unique(stored)
+        self.docs.append(stored)
+        return UpdateResult(1, doc["_id"])
+
+    @_locked
+    def insert_many(self, docs: List[Dict[str, Any]], ordered: bool = True):
+        self._raise_if_failing()
+        errors, inserted = [], []
+        for index, doc in enumerate(docs):
+            try:
+                self.insert_one(doc)
+                inserted.append(doc["_id"])
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted)})
+        return InsertManyResult(inserted)
+
+    def _upsert_doc(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: copy.deepcopy(_naive(value)) for key, value in query.items()
+                if not key.startswith("$") and not isinstance(value, dict)}
+
+    @_locked
+    def update_one(self, query, update, upsert: bool = False):
+        self._raise_if_failing()
+        for doc in self.docs:
+            if matches(doc, query):
+                updated = copy.deepcopy(doc)
+                _apply_update(updated, update, inserting=False)
+                self._check_unique(updated, ignore=doc)
+                doc.clear()
+                doc.update(updated)
+                return UpdateResult(1)
+        if upsert:
+            doc = self._upsert_doc(query)
+            _apply_update(doc, update, inserting=True)
+            doc.setdefault("_id", ObjectId())
+            self._check_unique(doc)
+            self.docs.append(doc)
+            return UpdateResult(0, doc["_id"])
+        return UpdateResult(0)
+
+    @_locked
+    def update_many(self, query, update):
+        self._raise_if_failing()
+        matched = [doc for doc in self.docs if matches(doc, query)]
+        for doc in matched:
+            _apply_update(doc, update, inserting=False)
+        return UpdateResult(len(matched))
+
+    @_locked
+    def replace_one(self, query, replacement, upsert: bool = False):
+        self._raise_if_failing()
+        for doc in self.docs:
+            if matches(doc, query):
+                new = {"_id": doc["_id"], **{k: _naive(v) for k, v in copy.deepcopy(replacement).items()}}
+                self._check_unique(new, ignore=doc)
+                doc.clear()
+                doc.update(new)
+                return UpdateResult(1)
+        if upsert:
+            return self.insert_one(dict(replacement))
+        return UpdateResult(0)
+
+    @_locked
+    def find_one_and_update(self, query, update, sort=None, return_document=False, upsert=False):
+        self._raise_if_failing()
+        candidates = list(self.find(query).sort(sort)) if sort else list(self.find(query))
+        if not candidates:
+            return None
+        target = next(doc for doc in self.docs if doc["_id"] == candidates[0]["_id"])
+        before = copy.deepcopy(target)
+        _apply_update(target, update, inserting=False)
+        return copy.deepcopy(target) if return_document else before
+
+    @_locked
+    def delete_many(self, query):
+        self._raise_if_failing()
+        kept = [doc for doc in self.docs if not matches(doc, query)]
+        deleted = len(self.docs) - len(kept)
+        self.docs = kept
+        return DeleteResult(deleted)
+
+    @_locked
+    def delete_one(self, query):
+        for index, doc in enumerate(self.docs):
+            if matches(doc, query):
+                del self.docs[index]
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+    # Reads -------------------------------------------------------------
+    @_locked
+    def find(self, query=None, projection=None, sort=None, limit=0, **kwargs):
+        query = query or {}
+        docs = [_project(doc, projection) if projection else copy.deepcopy(doc)
+                for doc in self.docs if matches(doc, query)]
+        cursor = FakeCursor(docs)
+        if sort:
+            cursor.sort(sort)
+        return cursor.limit(limit)
+
+    @_locked
+    def find_one(self, query=None, projection=None, sort=None, **kwargs):
+        for doc in self.find(query, projection, sort=sort):
+            return doc
+        return None
+
+    @_locked
+    def drop(self) -> None:
+        self.docs = []
+        self.unique_keys = []
+
+    @_locked
+    def count_documents(self, query) -> int:
+        return sum(1 for doc in self.docs if matches(doc, query))
+
+    @_locked
+    def distinct(self, field: str, query=None) -> List[Any]:
+        values = []
+        for doc in self.docs:
+            if matches(doc, query or {}) and _get(doc, field) not in values:
+                values.append(_get(doc, field))
+        return values
@@ -0,0 +1,163 @@
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pytest
+
+import activity_analytics
+import history_tool
+from fakes import FakeCollection
+
+CHAT = -100
+
+
+@pytest.fixture
+def db(monkeypatch):
+    messages, buckets = FakeCollection("messages"), FakeCollection("activity_buckets")
+    archived = []
+    monkeypatch.setattr(activity_analytics, "messages_collection", messages)
+    monkeypatch.setattr(activity_analytics, "activity_buckets_collection", buckets)
+    monkeypatch.setattr(activity_analytics, "message_buckets_collection", FakeCollection("message_buckets"))
+
+    def iter_archived_messages(chat_id, start=None, end=None):
+        return (doc for doc in archived
+                if (start is None or doc["timestamp"] >= start) and (end is None or doc["timestamp"] < end))
+
+    monkeypatch.setattr(activity_analytics, "iter_archived_messages", iter_archived_messages)
+    activity_analytics.ensure_indexes()
+    return messages, buckets, archived
+
+
+def _messages(count, seed=1):
+    rng = random.Random(seed)
+    start = datetime(2023, 12, 20, tzinfo=timezone.utc)
+    return [{
+        "chat_id": CHAT, "message_id": n, "user_id": rng.choice([1, 2, 3]),
+        "username": None, "full_name": "someone",
+        "timestamp": start + timedelta(minutes=rng.randrange(60 * 24 * 30)),
+    } for n in range(count)]
+
+
+def test_rebuild_matches_live_counting_including_archived_history(db):
+    messages, buckets, archived = db
+    docs = _messages(500)
+    archived.extend(docs[:200])
+    for doc in docs[200:]:
+        messages.insert_one(dict(doc))
+        activity_analytics.record_activity(doc)
+
+    assert activity_analytics.rebuild_activity(CHAT) == 500
+
+    start, end = datetime(2023, 12, 1, tzinfo=timezone.utc), datetime(2024, 2, 1, tzinfo=timezone.utc)
+    hourly = activity_analytics.chat_hourly(CHAT, start, end)
+    expected = np.zeros(len(hourly), dtype=np.int64)
+    for doc in docs:
+        expected[int((doc["timestamp"] - start).total_seconds() // 3600)] += 1
+    assert (hourly == expected).all()
+
+    totals = {user["user_id"]: user["count"] for user in activity_analytics.user_totals(CHAT, start, end)}
+    for user_id in (1, 2, 3):
+        assert totals[user_id] == sum(1 for doc in docs if doc["user_id"] == user_id)
+
+
+def test_rebuild_replaces_buckets_in_place(db, monkeypatch):
+    messages, buckets, _ = db
+    doc = _messages(1)[0]
+    messages.insert_one(dict(doc))
+    activity_analytics.record_activity(doc)
+    activity_analytics.record_activity(doc)  # Double count to be corrected.
+    ids = sorted(str(bucket["_id"]) for bucket in buckets.docs)
+
+    def no_delete(*args, **kwargs):
+        raise AssertionError("rebuild must not drop the chat's buckets")
+
+    monkeypatch.setattr(buckets, "delete_many", no_delete)
+    activity_analytics.rebuild_activity(CHAT)
+    assert sorted(str(bucket["_id"]) for bucket in buckets.docs) == ids
+    assert all(bucket["total"] == 1 for bucket in buckets.docs)
+
+
+def test_history_import_rebuilds_the_chat_buckets(db, monkeypatch, tmp_path):
+    messages, buckets, _ = db
+    import db_functions
+    monkeypatch.setattr(db_functions, "messages_collection", messages)
+    monkeypatch.setattr(db_functions, "message_buckets_collection", activity_analytics.message_buckets_collection)
+    path = tmp_path / "export.json"
+    history_tool.write_synthetic_export(str(path), 50, users=5)
+
+    stats = history_tool.import_export(str(path))
+    assert stats["inserted"] == 50
+    assert stats["activity_messages"] == 50
+    assert sum(bucket["total"] for bucket in buckets.docs if bucket["user_id"] is None) == 50
+
+
+def _record(messages, timestamps, user_id=1):
+    for n, ts in enumerate(timestamps):
+        doc = {"chat_id": CHAT, "message_id": n, "user_id": user_id, "username": None,
+               "full_name": "someone", "timestamp": ts}
+        messages.insert_one(dict(doc))
+        activity_analytics.record_activity(doc)
+
+
+def test_user_totals_count_partial_days_exactly(db):
+    messages, _, archived = db
+    docs = _messages(300)
+    archived.extend(docs[:100])
+    for doc in docs[100:]:
+        messages.insert_one(dict(doc))
+    activity_analytics.rebuild_activity(CHAT)
+
+    # Local midnights in +5:30 fall mid-way through UTC days.
+    start = datetime(2023, 12, 24, 18, 30, tzinfo=timezone.utc)
+    for end in (start + timedelta(hours=5), start + timedelta(days=7)):
+        totals = {user["user_id"]: user["count"] for user in activity_analytics.user_totals(CHAT, start, end)}
+        for user_id in (1, 2, 3):
+            assert totals.get(user_id, 0) == sum(1 for doc in docs
+                                                 if doc["user_id"] == user_id and start <= doc["timestamp"] < end)
+
+
+def test_heatmap_uses_the_offset_in_effect_at_each_hour(db):
+    messages, _, _ = db
+    amsterdam = ZoneInfo("Europe/Amsterdam")
+    # 10:00 UTC is 12:00 local in summer (CEST) and 11:00 local in winter (CET).
+    summer, winter = datetime(2024, 10, 21, 10, tzinfo=timezone.utc), datetime(2024, 10, 28, 10, tzinfo=timezone.utc)
+    _record(messages, [summer, winter])
+    heatmap = activity_analytics.hour_of_week_heatmap(CHAT, summer - timedelta(days=1), winter + timedelta(days=1),
+                                                      amsterdam)
+    assert heatmap[0, 12] == 1 and heatmap[0, 11] == 1
+    assert heatmap.sum() == 2
+
+
+def test_half_hour_offsets_count_each_hour_where_it_starts(db):
+    messages, _, _ = db
+    kolkata = ZoneInfo("Asia/Kolkata")
+    # 18:00 and 18:45 UTC on Sunday are 23:30 and 00:15 local; both are in the
+    # UTC hour starting at 23:30 local, so both count on Sunday at 23:00.
+    _record(messages, [datetime(2024, 6, 2, 18, 0, tzinfo=timezone.utc), datetime(2024, 6, 2, 18, 45, tzinfo=timezone.utc),
+                       datetime(2024, 6, 2, 19, 0, tzinfo=timezone.utc)])
+    heatmap = activity_analytics.hour_of_week_heatmap(CHAT, datetime(2024, 6, 1, tzinfo=timezone.utc),
+                                                      datetime(2024, 6, 4, tzinfo=timezone.utc), kolkata)
+    assert heatmap[6, 23] == 2 and heatmap[0, 0] == 1
+
+    days, counts = activity_analytics.daily_trend(CHAT, 3, kolkata, now=datetime(2024, 6, 3, 12, tzinfo=timezone.utc))
+    assert [day.strftime("%d.%m") for day in days] == ["01.06", "02.06", "03.06"]
+    assert days[0].utcoffset() == timedelta(hours=5, minutes=30)
+    assert counts.tolist() == [0, 2, 1]
+
+
+def test_period_statistics_use_the_chat_timezone(db, monkeypatch):
+    import command_handlers
+    messages, _, _ = db
+    tz = ZoneInfo("Asia/Kolkata")
+    now = datetime.now(tz)
+    midnight = datetime(now.year, now.month, now.day, tzinfo=tz)
+    # Just after local midnight today, and just before it; both can be the same UTC day.
+    _record(messages, [midnight + timedelta(seconds=1)], user_id=1)
+    _record(messages, [midnight - timedelta(seconds=1)], user_id=2)
+    monkeypatch.setattr(command_handlers, "chat_timezone", lambda chat_id: tz)
+
+    text = command_handlers.get_period_statistics_text(CHAT, "day", 1)
+    assert "Total messages: 1" in text
+    text = command_handlers.get_period_statistics_text(CHAT, "week", 7)
+    assert "Total messages: 2" in text
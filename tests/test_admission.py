@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import pytest
+
+from admission import AdmissionController, OverloadedError, Priority
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _slow_call(clock, seconds):
+    def call():
+        clock.now += seconds
+        return "done"
+    return call
+
+
+def test_slow_burst_sheds_lower_tiers():
+    clock = FakeClock()
+    controller = AdmissionController(max_in_flight=4, clock=clock)
+
+    async def scenario():
+        for _ in range(3):
+            await controller.run(Priority.COMMAND, _slow_call(clock, 120))
+        with pytest.raises(OverloadedError):
+            await controller.run(Priority.SCHEDULED, _slow_call(clock, 1))
+        with pytest.raises(OverloadedError):
+            await controller.run(Priority.QUIP, _slow_call(clock, 1))
+
+    asyncio.run(scenario())
+    assert controller.metrics["shed"]["SCHEDULED"] == 1
+    assert controller.metrics["shed"]["QUIP"] == 1
+
+
+def test_latency_decays_while_idle():
+    clock = FakeClock()
+    controller = AdmissionController(max_in_flight=4, latency_half_life=60.0, clock=clock)
+
+    async def scenario():
+        for _ in range(3):
+            await controller.run(Priority.COMMAND, _slow_call(clock, 120))
+        assert controller.current_latency() > 20.0
+        clock.now += 24 * 3600
+        assert controller.current_latency() < 1.0
+        for _ in range(10):
+            assert await controller.run(Priority.SCHEDULED, _slow_call(clock, 1)) == "done"
+            assert await controller.run(Priority.QUIP, _slow_call(clock, 1)) == "done"
+
+    asyncio.run(scenario())
+    assert controller.metrics["shed"]["SCHEDULED"] == 0
+    assert controller.metrics["shed"]["QUIP"] == 0
+
+
+def test_commands_are_served_before_queued_lower_tiers():
+    controller = AdmissionController(max_in_flight=1, clock=time.monotonic)
+    order = []
+
+    def record(name):
+        time.sleep(0.01)
+        order.append(name)
+
+    async def scenario():
+        first = asyncio.create_task(controller.run(Priority.COMMAND, record, "first"))
+        await asyncio.sleep(0)
+        scheduled = asyncio.create_task(controller.run(Priority.SCHEDULED, record, "scheduled"))
+        command = asyncio.create_task(controller.run(Priority.COMMAND, record, "command"))
+        await asyncio.gather(first, scheduled, command)
+
+    asyncio.run(scenario())
+    assert order == ["first", "command", "scheduled"]
+
+
+def test_deployment_limit_is_split_across_shard_processes():
+    from sharding import ai_share
+    assert ai_share(3, total=8) == 2
+    assert ai_share(4, total=4) == 1
+    controller = AdmissionController(max_in_flight=8)
+    controller.set_max_in_flight(ai_share(3, total=8))
+    assert controller.max_in_flight == 2
+    assert controller.shed_in_flight[Priority.QUIP] == 1
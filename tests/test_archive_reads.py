@@ -0,0 +1,125 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import ai_functions_lib
+import db_functions
+import history_tool
+from fakes import FakeCollection
+from message_cache import RecentMessageCache
+from retention import build_bucket
+
+CHAT = -100
+# Recent enough for /profile's archive window.
+DAY = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=30)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    messages, buckets, profiles = FakeCollection("messages"), FakeCollection("message_buckets"), FakeCollection()
+    monkeypatch.setattr(db_functions, "messages_collection", messages)
+    monkeypatch.setattr(db_functions, "message_buckets_collection", buckets)
+    monkeypatch.setattr(db_functions, "user_profiles_collection", profiles)
+    profiles.insert_one({"chat_id": CHAT, "user_id": 1, "username": "ann", "full_name": "Ann Archive"})
+    profiles.insert_one({"chat_id": CHAT, "user_id": 2, "username": "bob", "full_name": "Bob Recent"})
+    return messages, buckets
+
+
+def _doc(n, day, hour, user_id):
+    return {"message_id": n, "chat_id": CHAT, "user_id": user_id, "text": f"message {n}",
+            "timestamp": day + timedelta(hours=hour)}
+
+
+def _archive(buckets, days=3, per_day=4):
+    """
+    Compact `days` days of `per_day` messages from Ann into archive buckets.
+    """
+    n = 0
+    for offset in range(days):
+        day = DAY + timedelta(days=offset)
+        raw = [_doc(n + i, day, 2 * i, 1) for i in range(per_day)]
+        n += per_day
+        buckets.insert_one(build_bucket(CHAT, day, raw))
+
+
+def test_archived_count_includes_only_the_covered_part_of_edge_days(db):
+    _, buckets = db
+    _archive(buckets)
+    assert db_functions.count_archived_messages(CHAT) == 12
+    # Hours 0, 2, 4, 6 each day: from 03:00 on day one to 03:00 on day three.
+    start, end = DAY + timedelta(hours=3), DAY + timedelta(days=2, hours=3)
+    assert db_functions.count_archived_messages(CHAT, start, end) == 2 + 4 + 2
+    assert db_functions.count_archived_messages(CHAT, start, end) == \
+        sum(1 for _ in db_functions.iter_archived_messages(CHAT, start, end))
+
+
+def test_export_progress_total_counts_archived_messages(db, monkeypatch, tmp_path):
+    messages, buckets = db
+    _archive(buckets)
+    for n in range(100, 105):
+        messages.insert_one(_doc(n, DAY + timedelta(days=5), n - 100, 2))
+    totals = []
+
+    class Progress:
+        def __init__(self, total, **kwargs):
+            totals.append(total)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def update(self, count):
+            pass
+
+    monkeypatch.setattr(history_tool, "tqdm", Progress)
+    exported = history_tool.export_chat(CHAT, str(tmp_path / "out.jsonl.gz"))
+    assert exported == 17
+    assert totals == [17]
+
+
+def _profile(monkeypatch, name):
+    replies, prompts = [], []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    async def reply_completion(update, messages, **kwargs):
+        prompts.append(messages[-1]["content"])
+
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=CHAT),
+                             message=SimpleNamespace(reply_text=reply_text))
+    monkeypatch.setattr(ai_functions_lib, "_reply_completion", reply_completion)
+    asyncio.run(ai_functions_lib.profile_command(update, SimpleNamespace(args=[name])))
+    return replies, prompts
+
+
+@pytest.mark.parametrize("name", ["@ann", "Ann"])
+def test_profile_finds_users_who_only_appear_in_archived_history(db, monkeypatch, name):
+    messages, buckets = db
+    _archive(buckets)
+    cache = RecentMessageCache(per_chat=50)
+    for n in range(100, 105):
+        doc = _doc(n, DAY + timedelta(days=5), n - 100, 2)
+        messages.insert_one(dict(doc))
+        cache.ingest(doc)
+    monkeypatch.setattr("message_cache.message_cache", cache)
+
+    replies, prompts = _profile(monkeypatch, name)
+    assert replies == []
+    assert "message 11" in prompts[0] and "message 0" in prompts[0]
+    assert "message 100" not in prompts[0]
+
+
+def test_profile_archive_scan_is_bounded_to_recent_days(db, monkeypatch):
+    _, buckets = db
+    _archive(buckets)
+    monkeypatch.setattr("message_cache.message_cache", RecentMessageCache(per_chat=50))
+    monkeypatch.setattr(ai_functions_lib, "PROFILE_ARCHIVE_DAYS", 7)
+
+    replies, prompts = _profile(monkeypatch, "@ann")
+    assert replies == ["User not found."]
+    assert prompts == []
@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import digests
+from fakes import FakeCollection
+
+UTC = timezone.utc
+CHAT = -100
+
+
+@pytest.fixture
+def db(monkeypatch):
+    messages, stored = FakeCollection("messages"), FakeCollection("daily_digests")
+    monkeypatch.setattr(digests, "messages_collection", messages)
+    monkeypatch.setattr(digests, "daily_digests_collection", stored)
+    monkeypatch.setattr(digests, "get_chat_info", lambda chat_id: {"timezone": "UTC"})
+    monkeypatch.setattr(digests, "DIGEST_HOUR", 20)
+    # Keep the in-process ring out of the way; every read goes to the fake collection.
+    monkeypatch.setattr(digests.message_cache, "window", lambda *args: None)
+    calls = []
+
+    async def fake_summary(texts, priority):
+        calls.append(len(texts))
+        return f"{len(texts)} messages"
+
+    monkeypatch.setattr(digests, "summarize_texts", fake_summary)
+    return messages, stored, calls
+
+
+def _message(messages, ts, n):
+    messages.insert_one({"chat_id": CHAT, "message_id": n, "text": f"m{n}", "timestamp": ts})
+
+
+def test_a_day_is_summarized_at_digest_hour_and_once_after_it_ends(db):
+    messages, stored, calls = db
+    day = datetime(2024, 5, 1, tzinfo=UTC)
+    _message(messages, day + timedelta(hours=9), 1)
+
+    def sweep(at):
+        return asyncio.run(digests.run_digest_batch(now=at))
+
+    assert sweep(day + timedelta(hours=19)) == 0
+    assert sweep(day + timedelta(hours=20)) == 1
+    # New messages during the evening don't trigger a recompute on every sweep.
+    for minutes in range(15, 240, 15):
+        _message(messages, day + timedelta(hours=20, minutes=minutes - 5), 100 + minutes)
+        assert sweep(day + timedelta(hours=20, minutes=minutes)) == 0
+    assert calls == [1]
+
+    # After midnight the day is finalized once with everything it contained.
+    assert sweep(day + timedelta(days=1, minutes=15)) == 1
+    assert sweep(day + timedelta(days=1, minutes=30)) == 0
+    assert calls == [1, 16]
+    assert stored.find_one({"day": "2024-05-01"})["message_count"] == 16
+
+
+def test_missed_evening_is_caught_up_the_next_day(db):
+    messages, stored, calls = db
+    day = datetime(2024, 5, 1, tzinfo=UTC)
+    _message(messages, day + timedelta(hours=9), 1)
+    assert asyncio.run(digests.run_digest_batch(now=day + timedelta(days=1, hours=8))) == 1
+    assert asyncio.run(digests.run_digest_batch(now=day + timedelta(days=1, hours=9))) == 0
+    assert calls == [1]
+
+
+def test_a_failed_chunk_fails_the_whole_summary(monkeypatch):
+    from ai_functions_lib import AI_ERROR_MESSAGE
+    replies = iter([AI_ERROR_MESSAGE, "second part", "ok summary"])
+
+    async def fake_completion(messages, max_tokens, temperature, priority):
+        return next(replies)
+
+    monkeypatch.setattr(digests, "_admitted_completion", fake_completion)
+    monkeypatch.setattr(digests, "DIGEST_CHUNK_CHARS", 10)
+    with pytest.raises(RuntimeError):
+        asyncio.run(digests.summarize_texts(["first chunk", "second chunk"], digests.Priority.SCHEDULED))
+
+
+def _summary_command():
+    import ai_functions_lib
+    from types import SimpleNamespace
+    replies, tasks = [], []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=CHAT), message=SimpleNamespace(reply_text=reply_text))
+    context = SimpleNamespace(application=SimpleNamespace(create_task=tasks.append))
+    asyncio.run(ai_functions_lib.daily_summary_command(update, context))
+    return replies, tasks
+
+
+def test_summary_serves_a_stale_digest_and_refreshes_it_in_the_background(db, monkeypatch):
+    messages, stored, calls = db
+    now = datetime.now(UTC)
+    today = now.date()
+    midnight = datetime(today.year, today.month, today.day, tzinfo=UTC)
+    stored.insert_one({"chat_id": CHAT, "day": today.isoformat(), "summary": "old summary", "message_count": 0,
+                       "last_message_at": midnight, "generated_at": now - timedelta(minutes=5)})
+    _message(messages, midnight + timedelta(seconds=1), 2)
+
+    # Too recent to refresh yet.
+    assert _summary_command() == (["old summary"], [])
+
+    monkeypatch.setattr(digests, "DIGEST_REFRESH_SECONDS", 60)
+    replies, tasks = _summary_command()
+    assert replies == ["old summary"]
+    assert calls == []
+    asyncio.run(tasks[0])
+    assert calls == [1]
+    assert stored.find_one({"day": today.isoformat()})["summary"] == "1 messages"
+
+    # Fresh again: nothing left to refresh.
+    assert _summary_command() == (["1 messages"], [])
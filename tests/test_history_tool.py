@@ -0,0 +1,132 @@
+import gzip
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import db_functions
+import history_tool
+from fakes import FakeCollection
+from history_tool import ExportReader, bot_api_chat_id, export_message_to_doc
+
+EXPORT = {
+    "name": "Дачный чат 🌻",
+    "type": "private_supergroup",
+    "id": 1234567890,
+    "messages": [
+        {"id": 1, "type": "service", "date": "2024-05-01T09:00:00", "actor": "Аня", "action": "create_group"},
+        {"id": 2, "type": "message", "date": "2024-05-01T09:01:00", "date_unixtime": "1714554060",
+         "from": "Аня", "from_id": "user42", "text": "Привет всем! 🌻"},
+        {"id": 3, "type": "message", "date": "2024-05-01T09:02:00", "from": "Новости", "from_id": "channel7",
+         "text": "Репост из канала"},
+        {"id": 4, "type": "message", "date": "2024-05-01T09:03:00", "from": "Борис", "from_id": "user43",
+         "text": ["Смотрите ", {"type": "bold", "text": "сюда"}, " 👀"]},
+        {"id": 5, "type": "message", "date": "2024-05-01T09:04:00", "from": "Борис", "from_id": "user43",
+         "text": "", "photo": "photos/1.jpg"},
+        {"id": 6, "type": "message", "date": "2024-05-01T09:05:00", "date_unixtime": "1714554300",
+         "from": "Аня", "from_id": "user42", "text": "Ок"},
+    ],
+}
+
+
+@pytest.fixture
+def export_path(tmp_path):
+    path = tmp_path / "result.json"
+    path.write_text(json.dumps(EXPORT, ensure_ascii=False, indent=1), encoding="utf-8")
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 2, 3, 7, 64, 1 << 20])
+def test_reader_handles_chunks_splitting_objects_and_characters(export_path, chunk_bytes):
+    reader = ExportReader(export_path, chunk_bytes=chunk_bytes)
+    assert list(reader) == EXPORT["messages"]
+    assert reader.header == {"id": 1234567890, "type": "private_supergroup"}
+
+
+def test_reader_reports_truncated_exports(tmp_path):
+    path = tmp_path / "broken.json"
+    text = json.dumps(EXPORT, ensure_ascii=False)
+    path.write_text(text[:text.index('"id": 4')], encoding="utf-8")
+    with pytest.raises(ValueError, match="middle of the messages array"):
+        list(ExportReader(str(path), chunk_bytes=5))
+
+    path.write_text('{"name": "no messages here"}', encoding="utf-8")
+    with pytest.raises(ValueError, match="no top-level 'messages' array"):
+        list(ExportReader(str(path), chunk_bytes=5))
+
+
+def test_bot_api_chat_ids():
+    assert bot_api_chat_id(1234567890, "private_supergroup") == -1001234567890
+    assert bot_api_chat_id(1234567890, "public_channel") == -1001234567890
+    assert bot_api_chat_id(4321, "private_group") == -4321
+    assert bot_api_chat_id(42, "personal_chat") == 42
+
+
+def test_only_text_messages_from_users_are_converted():
+    docs = [export_message_to_doc(message, -100) for message in EXPORT["messages"]]
+    assert [doc["message_id"] for doc in docs if doc] == [2, 4, 6]
+    assert docs[1]["timestamp"] == datetime(2024, 5, 1, 9, 1, tzinfo=timezone.utc)
+    assert docs[3]["text"] == "Смотрите сюда 👀"
+    assert docs[3]["timestamp"] == datetime(2024, 5, 1, 9, 3, tzinfo=timezone.utc)
+    assert docs[3]["user_id"] == 43
+
+
+def test_reimport_counts_duplicates(export_path):
+    collection = FakeCollection("import_test")
+    first = history_tool.import_export(export_path, batch_size=2, collection=collection)
+    assert (first["parsed"], first["skipped"], first["inserted"], first["duplicates"]) == (6, 3, 3, 0)
+    assert first["chat_id"] == -1001234567890
+
+    second = history_tool.import_export(export_path, batch_size=2, collection=collection)
+    assert (second["inserted"], second["duplicates"]) == (0, 3)
+    assert len(collection.docs) == 3
+
+
+def test_dry_run_writes_nothing(export_path):
+    collection = FakeCollection("import_test")
+    stats = history_tool.import_export(export_path, dry_run=True, collection=collection)
+    assert (stats["parsed"], stats["skipped"], stats["inserted"]) == (6, 3, 0)
+    assert collection.docs == []
+
+
+def test_export_round_trips_imported_messages(export_path, tmp_path, monkeypatch):
+    collection = FakeCollection("messages")
+    monkeypatch.setattr(db_functions, "messages_collection", collection)
+    monkeypatch.setattr(db_functions, "message_buckets_collection", FakeCollection("message_buckets"))
+    monkeypatch.setattr(db_functions, "user_profiles_collection", FakeCollection("user_profiles"))
+    import activity_analytics
+    monkeypatch.setattr(activity_analytics, "rebuild_activity", lambda chat_id: 0)
+    history_tool.import_export(export_path)
+
+    out = tmp_path / "out.jsonl.gz"
+    assert history_tool.export_chat(-1001234567890, str(out)) == 3
+    with gzip.open(out, "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [row["text"] for row in rows] == ["Привет всем! 🌻", "Смотрите сюда 👀", "Ок"]
+    assert rows[0] == {
+        "message_id": 2, "chat_id": -1001234567890, "user_id": 42, "username": None, "full_name": "Аня",
+        "text": "Привет всем! 🌻", "timestamp": "2024-05-01T09:01:00+00:00",
+    }
+
+
+def test_reimport_after_compaction_skips_archived_messages(tmp_path, monkeypatch):
+    import activity_analytics
+    import retention
+    messages, buckets, profiles = FakeCollection("messages"), FakeCollection("message_buckets"), FakeCollection()
+    for module in (db_functions, retention, activity_analytics):
+        monkeypatch.setattr(module, "messages_collection", messages)
+        monkeypatch.setattr(module, "message_buckets_collection", buckets)
+    monkeypatch.setattr(db_functions, "user_profiles_collection", profiles)
+    monkeypatch.setattr(retention, "user_profiles_collection", profiles)
+    monkeypatch.setattr(activity_analytics, "activity_buckets_collection", FakeCollection("activity_buckets"))
+    path = str(tmp_path / "export.json")
+    history_tool.write_synthetic_export(path, 30, users=3)
+
+    assert history_tool.import_export(path)["inserted"] == 30
+    retention.compact_day(-1001234567890, datetime(2023, 1, 1, tzinfo=timezone.utc))
+    assert messages.docs == []
+
+    again = history_tool.import_export(path)
+    assert (again["inserted"], again["duplicates"]) == (0, 30)
+    assert messages.docs == []
+    assert activity_analytics.rebuild_activity(-1001234567890) == 30
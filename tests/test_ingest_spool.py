@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import activity_analytics
+import db_functions
+import ingest_spool
+from fakes import FakeCollection
+from ingest_spool import SPOOLED, STORED, IngestSpool
+
+CHAT = -100
+START = datetime(2024, 6, 1, 8, 0)
+
+
+class SlowCollection(FakeCollection):
+    """
+    Single inserts block until `release` is set, like a primary stuck in an election.
+    """
+
+    def __init__(self, name: str = "messages"):
+        super().__init__(name)
+        self.release = threading.Event()
+        self.release.set()
+
+    def insert_one(self, doc):
+        self.release.wait()
+        return super().insert_one(doc)
+
+
+class SlowBuckets(FakeCollection):
+    """
+    Activity buckets that answer, but slowly.
+    """
+
+    def update_one(self, *args, **kwargs):
+        time.sleep(0.2)
+        return super().update_one(*args, **kwargs)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def messages(monkeypatch):
+    collection = SlowCollection()
+    monkeypatch.setattr(db_functions, "messages_collection", collection)
+    monkeypatch.setattr(ingest_spool, "messages_collection", collection)
+    return collection
+
+
+def _spool(path, stored, clock=None):
+    return IngestSpool(str(path), latency_budget=0.05, cooldown=10, batch_size=3,
+                       on_stored=lambda doc: stored.append(doc["message_id"]), clock=clock or Clock())
+
+
+def _doc(n):
+    return {"message_id": n, "chat_id": CHAT, "user_id": 1, "text": f"message {n}",
+            "timestamp": START + timedelta(minutes=n)}
+
+
+def _ids(messages):
+    return [doc["message_id"] for doc in messages.docs]
+
+
+def test_insert_within_budget_is_stored_directly(messages, tmp_path):
+    stored = []
+    spool = _spool(tmp_path / "spool.db", stored)
+    assert asyncio.run(spool.store(_doc(1))) == STORED
+    assert _ids(messages) == [1]
+    assert stored == [1]
+    assert not spool.has_backlog()
+
+
+def test_slow_activity_buckets_do_not_hold_up_store(messages, tmp_path, monkeypatch):
+    buckets = SlowBuckets("activity_buckets")
+    monkeypatch.setattr(activity_analytics, "activity_buckets_collection", buckets)
+    spool = IngestSpool(str(tmp_path / "spool.db"), latency_budget=0.05,
+                        on_stored=activity_analytics.record_activity, clock=Clock())
+
+    async def timed_store():
+        started = time.monotonic()
+        outcome = await spool.store(_doc(1))
+        return outcome, time.monotonic() - started
+
+    # asyncio.run waits for the hook to finish in its worker thread.
+    outcome, elapsed = asyncio.run(timed_store())
+    assert outcome == STORED
+    assert elapsed < 0.15
+    assert not spool.has_backlog()
+    assert sum(bucket["total"] for bucket in buckets.docs) == 2
+
+
+def test_timed_out_insert_that_completes_records_activity_once(messages, tmp_path):
+    stored = []
+    spool = _spool(tmp_path / "spool.db", stored)
+
+    async def timeout_then_recover():
+        messages.release.clear()
+        outcome = await spool.store(_doc(1))
+        messages.release.set()
+        return outcome
+
+    # asyncio.run waits for the abandoned insert thread before returning.
+    assert asyncio.run(timeout_then_recover()) == SPOOLED
+    assert _ids(messages) == [1]
+    assert stored == [1]
+    assert spool.counters["late_stored"] == 1
+
+    assert spool.drain_once() == 1
+    assert spool.counters["duplicates"] == 1
+    assert _ids(messages) == [1]
+    assert stored == [1]
+
+
+def test_outage_spools_in_order_and_drains_after_recovery(messages, tmp_path):
+    stored = []
+    clock = Clock()
+    spool = _spool(tmp_path / "spool.db", stored, clock)
+    messages.fail_with = ServerSelectionTimeoutError("no primary")
+
+    async def ingest(numbers):
+        return [await spool.store(_doc(n)) for n in numbers]
+
+    assert asyncio.run(ingest(range(5))) == [SPOOLED] * 5
+    assert spool.metrics()["backlog"] == 5
+    assert stored == []
+
+    # Back up, but the backlog must drain first so arrival order is kept.
+    messages.fail_with = None
+    clock.now += 60
+    assert asyncio.run(ingest([5])) == [SPOOLED]
+    asyncio.run(spool.drain(None))
+    assert _ids(messages) == list(range(6))
+    assert stored == list(range(6))
+    assert spool.metrics()["backlog"] == 0
+
+
+def test_failed_drain_keeps_the_backlog(messages, tmp_path):
+    spool = _spool(tmp_path / "spool.db", [])
+    messages.fail_with = ServerSelectionTimeoutError("no primary")
+    asyncio.run(spool.store(_doc(1)))
+    asyncio.run(spool.drain(None))
+    assert spool.metrics()["backlog"] == 1
+    assert messages.docs == []
+
+
+def test_new_process_drains_the_spool_it_finds_on_disk(messages, tmp_path):
+    path = tmp_path / "spool.db"
+    before_crash = _spool(path, [])
+    messages.fail_with = ServerSelectionTimeoutError("no primary")
+    for n in range(7):
+        asyncio.run(before_crash.store(_doc(n)))
+    # The process dies without closing its connection.
+    messages.fail_with = None
+
+    stored = []
+    restarted = _spool(path, stored)
+    assert restarted.has_backlog()
+    asyncio.run(restarted.drain(None))
+    assert _ids(messages) == list(range(7))
+    assert stored == list(range(7))
+    assert restarted.counters["drained"] == 7
+
+
+def test_crash_between_insert_and_delete_replays_as_duplicates(messages, tmp_path, monkeypatch):
+    path = tmp_path / "spool.db"
+    first = _spool(path, [])
+    for n in range(5):
+        first.append(_doc(n))
+
+    insert_batch = first._insert_batch
+
+    def insert_then_crash(docs):
+        insert_batch(docs)
+        raise KeyboardInterrupt("killed before the spool rows were deleted")
+
+    monkeypatch.setattr(first, "_insert_batch", insert_then_crash)
+    with pytest.raises(KeyboardInterrupt):
+        first.drain_once()
+    assert _ids(messages) == [0, 1, 2]
+
+    stored = []
+    restarted = _spool(path, stored)
+    asyncio.run(restarted.drain(None))
+    assert _ids(messages) == list(range(5))
+    assert restarted.counters["duplicates"] == 3
+    assert restarted.counters["drained"] == 2
+    # The replayed duplicates were already counted by the first process.
+    assert stored == [3, 4]
+    assert not restarted.has_backlog()
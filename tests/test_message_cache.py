@@ -0,0 +1,174 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import db_functions
+from fakes import FakeCollection
+from message_cache import ChatRing, RecentMessageCache
+
+CHAT = -100
+START = datetime(2024, 6, 1, 8, 0)
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    collection = FakeCollection("message_buckets")
+    monkeypatch.setattr(db_functions, "message_buckets_collection", collection)
+    return collection
+
+
+@pytest.fixture
+def messages(monkeypatch, buckets):
+    collection = FakeCollection("messages")
+    monkeypatch.setattr(db_functions, "messages_collection", collection)
+    return collection
+
+
+def _doc(n, chat_id=CHAT, seconds=None, user_id=None, text=None):
+    return {
+        "message_id": n, "chat_id": chat_id, "user_id": user_id or 1 + n % 3,
+        "username": f"user{n % 3}", "full_name": f"User {n % 3}",
+        "text": text or f"message {n}",
+        "timestamp": START + timedelta(seconds=seconds if seconds is not None else n * 60),
+    }
+
+
+def _store(messages, cache, doc):
+    """
+    What message_handler does: insert into MongoDB, then ingest.
+    """
+    messages.insert_one(dict(doc))
+    cache.ingest(doc)
+
+
+def _from_db(messages, query, sort=1, limit=0):
+    return list(messages.find({"chat_id": CHAT, **query}).sort([("timestamp", sort), ("message_id", sort)])
+                .limit(limit))
+
+
+def _ids(docs):
+    return [doc["message_id"] for doc in docs]
+
+
+def test_warm_up_merges_messages_ingested_before_it(messages):
+    cache = RecentMessageCache(per_chat=10)
+    for n in range(5):
+        messages.insert_one(_doc(n))
+    # Ingested by this process before the first read: 5 is also in MongoDB,
+    # 6 is still on its way (e.g. spooled).
+    _store(messages, cache, _doc(5))
+    cache.ingest(_doc(6))
+
+    assert _ids(cache.recent(CHAT, 10)) == [0, 1, 2, 3, 4, 5, 6]
+    assert cache.counters["misses"] == 1
+
+
+def test_ring_wraps_around_and_keeps_the_newest_messages():
+    ring = ChatRing(4)
+    for n in range(10):
+        ring.append(_doc(n))
+    assert ring.size == 4
+    assert [ring.to_doc(CHAT, i)["message_id"] for i in ring.indices()] == [6, 7, 8, 9]
+    assert ring.oldest_timestamp() == (START + timedelta(minutes=6)).replace(tzinfo=timezone.utc).timestamp()
+    assert not ring.complete
+
+
+def test_least_recently_used_chats_are_evicted_under_the_byte_cap(messages):
+    probe = RecentMessageCache(per_chat=20)
+    probe.ingest(_doc(0, chat_id=1))
+    one_chat = probe.nbytes
+    cache = RecentMessageCache(per_chat=20, max_bytes=int(one_chat * 2.5))
+    for chat_id in (1, 2, 3):
+        cache.ingest(_doc(chat_id, chat_id=chat_id))
+    assert list(cache._rings) == [2, 3]
+    assert cache.counters["evictions"] == 1
+    assert cache.nbytes <= cache.max_bytes
+
+    # Reading a chat makes it the most recently used one.
+    messages.insert_one(_doc(2, chat_id=2))
+    cache.recent(2, 5)
+    cache.ingest(_doc(4, chat_id=4))
+    assert list(cache._rings) == [2, 4]
+
+
+def test_reads_match_the_equivalent_mongo_queries(messages):
+    rng = random.Random(3)
+    cache = RecentMessageCache(per_chat=50)
+    seconds = 0
+    for n in range(120):
+        seconds += rng.choice([1, 30, 600])
+        _store(messages, cache, _doc(n, seconds=seconds, text=rng.choice(["hi", "lunch?", "ok"])))
+
+    assert _ids(cache.recent(CHAT, 20)) == _ids(_from_db(messages, {}, -1, 20))[::-1]
+
+    newest = messages.docs[-1]["timestamp"]
+    start, end = newest - timedelta(minutes=90), newest - timedelta(minutes=10)
+    window = cache.window(CHAT, start, end)
+    assert window is not None
+    assert _ids(window) == _ids(_from_db(messages, {"timestamp": {"$gte": start, "$lt": end}}))
+    # Older than what the ring holds: the caller must ask MongoDB.
+    assert cache.window(CHAT, START, end) is None
+
+    found = cache.search(CHAT, lambda doc: doc["user_id"] == 2 and doc["text"] == "ok", 5)
+    assert _ids(found) == _ids(_from_db(messages, {"user_id": 2, "text": "ok"}, -1, 5))
+    assert cache.search(CHAT, lambda doc: doc["text"] == "nobody says this", 5) is None
+
+
+def test_messages_sharing_the_oldest_timestamp_are_not_assumed_cached(messages):
+    cache = RecentMessageCache(per_chat=3)
+    for n in range(5):
+        _store(messages, cache, _doc(n, seconds=0))
+    assert cache.window(CHAT, START, START + timedelta(minutes=1)) is None
+    assert len(cache.recent(CHAT, 3)) == 3
+    assert cache.counters["stale"] == 0
+
+
+def test_complete_ring_answers_any_window_and_search(messages):
+    cache = RecentMessageCache(per_chat=50)
+    for n in range(10):
+        _store(messages, cache, _doc(n))
+    assert _ids(cache.window(CHAT, START - timedelta(days=1), START + timedelta(days=1))) == list(range(10))
+    assert cache.search(CHAT, lambda doc: doc["text"] == "nobody says this", 5) == []
+
+
+def test_ring_of_a_process_that_does_not_ingest_is_refreshed(messages):
+    # E.g. the sharding front: it reads for digests but workers ingest.
+    cache = RecentMessageCache(per_chat=50)
+    for n in range(5):
+        messages.insert_one(_doc(n))
+    day = (START - timedelta(hours=1), START + timedelta(days=1))
+    assert len(cache.window(CHAT, *day)) == 5
+
+    for n in range(5, 15):
+        messages.insert_one(_doc(n))
+    assert _ids(cache.window(CHAT, *day)) == list(range(15))
+    assert cache.counters["stale"] == 1
+
+    assert len(cache.window(CHAT, *day)) == 15
+    assert cache.counters["hits"] == 1
+
+
+def test_gap_left_while_a_chat_was_owned_by_another_worker_is_detected(messages):
+    cache = RecentMessageCache(per_chat=50)
+    for n in range(3):
+        _store(messages, cache, _doc(n))
+    assert len(cache.recent(CHAT, 50)) == 3
+    # The chat moved to another worker for a while, then came back.
+    for n in range(3, 8):
+        messages.insert_one(_doc(n))
+    _store(messages, cache, _doc(8))
+
+    assert _ids(cache.recent(CHAT, 50)) == list(range(9))
+
+
+def test_ring_of_a_chat_with_archived_history_is_never_complete(messages, buckets):
+    cache = RecentMessageCache(per_chat=50)
+    for n in range(10, 15):
+        _store(messages, cache, _doc(n))
+    # Messages 0-9 were compacted into an archive bucket.
+    buckets.insert_one({"chat_id": CHAT, "day": START, "count": 10})
+
+    assert not cache._ring_for_read(CHAT).complete
+    assert cache.search(CHAT, lambda doc: doc["user_id"] == 1, 100) is None
+    assert cache.window(CHAT, START - timedelta(days=1), START + timedelta(days=1)) is None
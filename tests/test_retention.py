@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import db_functions
+import retention
+from fakes import FakeCollection, matches
+
+CHAT = -100
+# Old enough for the default hot window.
+DAY = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=200)
+
+
+class AggregatingCollection(FakeCollection):
+    """
+    Messages collection that answers the `cold_days` pipeline.
+    """
+
+    def aggregate(self, pipeline, **kwargs):
+        match = pipeline[0]["$match"]
+        keys = {(doc["chat_id"], doc["timestamp"].replace(hour=0, minute=0, second=0, microsecond=0))
+                for doc in self.docs if matches(doc, match)}
+        return [{"_id": {"chat_id": chat_id, "day": day}} for chat_id, day in sorted(keys, key=lambda key: key[::-1])]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    messages, buckets, profiles = AggregatingCollection("messages"), FakeCollection("message_buckets"), FakeCollection()
+    for module in (db_functions, retention):
+        monkeypatch.setattr(module, "messages_collection", messages)
+        monkeypatch.setattr(module, "message_buckets_collection", buckets)
+        monkeypatch.setattr(module, "user_profiles_collection", profiles)
+    retention.ensure_indexes()
+    return messages, buckets, profiles
+
+
+def _insert(messages, n, day, hour, user_id=1, username="ann"):
+    messages.insert_one({"message_id": n, "chat_id": CHAT, "user_id": user_id, "username": username,
+                         "full_name": username.title(), "text": f"message {n}",
+                         "timestamp": day + timedelta(hours=hour)})
+
+
+def _bucket_ids(buckets, day):
+    bucket = buckets.find_one({"chat_id": CHAT, "day": day})
+    return [row[0] for row in db_functions.decode_bucket_rows(bucket)]
+
+
+def test_raw_messages_are_deleted_only_after_the_bucket_is_written(db, monkeypatch):
+    messages, buckets, _ = db
+    for n in range(4):
+        _insert(messages, n, DAY, n)
+
+    buckets.fail_with = ServerSelectionTimeoutError("no primary")
+    with pytest.raises(ServerSelectionTimeoutError):
+        retention.compact_day(CHAT, DAY)
+    assert len(messages.docs) == 4
+    buckets.fail_with = None
+
+    delete_many = messages.delete_many
+
+    def checked_delete(query):
+        assert _bucket_ids(buckets, DAY) == [0, 1, 2, 3]
+        return delete_many(query)
+
+    monkeypatch.setattr(messages, "delete_many", checked_delete)
+    stats = retention.compact_day(CHAT, DAY)
+    assert stats["messages"] == 4
+    assert messages.docs == []
+
+
+def test_rerun_merges_late_arrivals_by_message_id(db):
+    messages, buckets, _ = db
+    for n in range(3):
+        _insert(messages, n, DAY, n)
+    retention.compact_day(CHAT, DAY)
+    # A late message and a replayed copy of one already archived.
+    _insert(messages, 7, DAY, 1)
+    _insert(messages, 1, DAY, 1)
+    retention.compact_day(CHAT, DAY)
+
+    assert len(buckets.docs) == 1
+    assert buckets.docs[0]["count"] == 4
+    assert _bucket_ids(buckets, DAY) == [0, 1, 7, 2]
+    assert buckets.docs[0]["user_counts"] == [{"user_id": 1, "count": 4}]
+    assert messages.docs == []
+
+
+def test_oversized_buckets_stay_raw(db, monkeypatch):
+    messages, buckets, _ = db
+    for n in range(3):
+        _insert(messages, n, DAY, n)
+    monkeypatch.setattr(retention, "MAX_BUCKET_BYTES", 100)
+    assert retention.compact_day(CHAT, DAY) == {"messages": 0, "raw_bytes": 0, "bucket_bytes": 0}
+    assert len(messages.docs) == 3
+    assert buckets.docs == []
+
+
+def test_report_is_a_dry_run(db):
+    messages, buckets, profiles = db
+    for offset in range(3):
+        for n in range(20):
+            _insert(messages, offset * 100 + n, DAY + timedelta(days=offset), n)
+    before = len(messages.docs)
+
+    totals = retention.run_compaction(dry_run=True)
+    assert (totals["chat_days"], totals["messages"]) == (3, 60)
+    assert totals["dry_run"] and totals["saved_bytes"] > 0
+    assert len(messages.docs) == before
+    assert buckets.docs == [] and profiles.docs == []
+
+
+def test_compaction_keeps_the_hot_window_and_stops_at_max_days(db):
+    messages, buckets, _ = db
+    for offset in range(3):
+        _insert(messages, offset, DAY + timedelta(days=offset), 1)
+    recent = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    _insert(messages, 99, recent, 0)
+
+    totals = retention.run_compaction(pause=0, max_days=2)
+    assert (totals["chat_days"], totals["messages"]) == (2, 2)
+    assert [doc["message_id"] for doc in messages.docs] == [2, 99]
+
+    assert retention.run_compaction(pause=0)["chat_days"] == 1
+    assert [doc["message_id"] for doc in messages.docs] == [99]
+    assert len(buckets.docs) == 3
+
+
+def test_profile_names_keep_the_newest_when_days_run_out_of_order(db):
+    messages, _, profiles = db
+    _insert(messages, 1, DAY, 1, username="ann_old")
+    _insert(messages, 2, DAY + timedelta(days=1), 1, username="ann_new")
+
+    retention.compact_day(CHAT, DAY + timedelta(days=1))
+    retention.compact_day(CHAT, DAY)
+    assert len(profiles.docs) == 1
+    assert (profiles.docs[0]["username"], profiles.docs[0]["full_name"]) == ("ann_new", "Ann_New")
+
+    # In order, the newer day overwrites the older names.
+    _insert(messages, 3, DAY + timedelta(days=2), 1, username="ann_newest")
+    retention.compact_day(CHAT, DAY + timedelta(days=2))
+    assert profiles.docs[0]["username"] == "ann_newest"
@@ -0,0 +1,144 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from fakes import FakeCollection
+from scheduler import DONE, FAILED, LEASED, PENDING, PersistentScheduler
+
+START = datetime(2024, 3, 1, 12, 0)
+
+
+class Clock:
+    """
+    Controllable UTC clock; naive like the datetimes MongoDB returns.
+    """
+
+    def __init__(self, now: datetime = START):
+        self.now = now
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    def advance(self, **kwargs) -> None:
+        self.now += timedelta(**kwargs)
+
+
+def _scheduler(collection, clock, owner="a", **kwargs):
+    scheduler = PersistentScheduler(collection, owner=owner, clock=clock, **kwargs)
+    scheduler.ensure_indexes()
+    return scheduler
+
+
+def _recorder(sent):
+    async def handler(bot, job):
+        sent.append(job["data"]["n"])
+    return handler
+
+
+def test_jobs_due_during_downtime_run_on_the_next_sweep_in_due_order():
+    jobs, clock, sent = FakeCollection(), Clock(), []
+    scheduler = _scheduler(jobs, clock)
+    scheduler.register("week_message", _recorder(sent))
+    for n, days in ((2, 7), (1, 3), (3, 30)):
+        scheduler.schedule("week_message", START + timedelta(days=days), chat_id=n, data={"n": n})
+
+    assert asyncio.run(scheduler.run_due(None)) == 0
+
+    # The bot was down for two weeks; a fresh process with the same collection catches up.
+    clock.advance(days=14)
+    restarted = _scheduler(jobs, clock, owner="b")
+    restarted.register("week_message", _recorder(sent))
+    assert asyncio.run(restarted.run_due(None)) == 2
+    assert sent == [1, 2]
+    assert [job["status"] for job in jobs.docs] == [DONE, DONE, PENDING]
+
+
+def test_expired_lease_is_reclaimed_by_another_owner():
+    jobs, clock = FakeCollection(), Clock()
+    first = _scheduler(jobs, clock, owner="a", lease_seconds=300)
+    second = _scheduler(jobs, clock, owner="b", lease_seconds=300)
+    first.schedule("week_message", START, data={"n": 1})
+
+    # "a" claims the job and crashes before finishing it.
+    job = first._claim()
+    assert job["lease_owner"] == "a"
+    assert second._claim() is None
+
+    clock.advance(seconds=301)
+    sent = []
+    second.register("week_message", _recorder(sent))
+    assert asyncio.run(second.run_due(None)) == 1
+    assert sent == [1]
+
+    # The late finish of the crashed owner does not overwrite the result.
+    first._finish(job, {"status": FAILED})
+    assert jobs.docs[0]["status"] == DONE
+    assert jobs.docs[0]["attempts"] == 2
+
+
+def test_failed_jobs_are_retried_after_the_delay_until_max_attempts():
+    jobs, clock = FakeCollection(), Clock()
+    scheduler = _scheduler(jobs, clock, max_attempts=3, retry_delay=timedelta(minutes=5))
+    calls = []
+
+    async def failing(bot, job):
+        calls.append(clock.now)
+        raise RuntimeError("Telegram is down")
+
+    scheduler.register("week_message", failing)
+    scheduler.schedule("week_message", START)
+
+    asyncio.run(scheduler.run_due(None))
+    assert jobs.docs[0]["status"] == PENDING
+    assert jobs.docs[0]["due_at"] == START + timedelta(minutes=5)
+
+    # Not due again before the retry delay has passed.
+    clock.advance(minutes=4)
+    asyncio.run(scheduler.run_due(None))
+    assert len(calls) == 1
+
+    for _ in range(5):
+        clock.advance(minutes=5)
+        asyncio.run(scheduler.run_due(None))
+    assert len(calls) == 3
+    assert jobs.docs[0]["status"] == FAILED
+    assert jobs.docs[0]["error"] == "Telegram is down"
+
+
+def test_scheduling_an_existing_key_is_a_no_op():
+    jobs, clock = FakeCollection(), Clock()
+    scheduler = _scheduler(jobs, clock)
+    assert scheduler.schedule("week_message", START, chat_id=1, key="week_message:1")
+    assert not scheduler.schedule("week_message", START + timedelta(days=1), chat_id=1, key="week_message:1")
+    assert scheduler.schedule("week_message", START, chat_id=2, key="week_message:2")
+    assert len(jobs.docs) == 2
+    assert jobs.docs[0]["due_at"] == START
+
+
+def test_each_job_is_leased_only_when_its_handler_starts():
+    jobs, clock = FakeCollection(), Clock()
+    scheduler = _scheduler(jobs, clock, lease_seconds=300)
+    for n in range(3):
+        scheduler.schedule("week_message", START, data={"n": n})
+    sent = []
+
+    async def slow(bot, job):
+        sent.append((scheduler.owner, job["data"]["n"]))
+        # Together the jobs outlast a lease; the ones still waiting must not be leased yet.
+        assert all(doc["status"] != LEASED for doc in jobs.docs if doc["_id"] != job["_id"])
+        clock.advance(seconds=200)
+
+    scheduler.register("week_message", slow)
+    assert asyncio.run(scheduler.run_due(None)) == 3
+    assert sent == [("a", 0), ("a", 1), ("a", 2)]
+    assert all(doc["status"] == DONE and doc["attempts"] == 1 for doc in jobs.docs)
+
+
+def test_run_due_stops_after_batch_size_jobs():
+    jobs, clock, sent = FakeCollection(), Clock(), []
+    scheduler = _scheduler(jobs, clock, batch_size=2)
+    scheduler.register("week_message", _recorder(sent))
+    for n in range(5):
+        scheduler.schedule("week_message", START.replace(tzinfo=timezone.utc), data={"n": n})
+    assert asyncio.run(scheduler.run_due(None)) == 2
+    assert asyncio.run(scheduler.run_due(None)) == 2
+    assert asyncio.run(scheduler.run_due(None)) == 1